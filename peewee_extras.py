@@ -1,29 +1,165 @@
+import asyncio
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import functools
+import hashlib
+import heapq
+import hmac
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import lzma
+import os
+import re
+import threading
+import time
+import types
+import uuid
+import weakref
+import zlib
+
 import peewee
 import datetime
-import playhouse
+import playhouse.db_url
 
 from peewee import DateTimeField
 
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError: # pragma: nocover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError: # pragma: nocover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError: # pragma: nocover
+    zstandard = None
+
+try:
+    import numpy
+except ImportError: # pragma: nocover
+    numpy = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError: # pragma: nocover
+    pyarrow = None
+
 
 ####################################################################
 # Model manager
 ####################################################################
 
+def schema_fingerprint(model):
+    """Returns hash of the DDL creating model table and indexes"""
+    schema = model._schema
+    ddl = [schema._create_table(safe=True).query()]
+    ddl.extend(ctx.query() for ctx in schema._create_indexes(safe=True))
+    return hashlib.sha256(repr(ddl).encode('utf-8')).hexdigest()
+
+
 class ModelManager(list):
     """Handles model registration"""
 
+    # table recording schema fingerprints of created models
+    fingerprint_table = 'peewee_extras_schema'
+
     def __init__(self, database_manager):
         self.dbm = database_manager
 
-    def create_tables(self):
-        """Create database tables"""
+    def _by_database(self):
+        groups = collections.OrderedDict()
         for cls in self:
-            cls.create_table(fail_silently=True)
+            groups.setdefault(cls._meta.database, []).append(cls)
+        return groups.items()
+
+    def _fingerprints(self):
+        return peewee.Table(self.fingerprint_table,
+            ('table_name', 'fingerprint'))
+
+    def get_fingerprints(self, db):
+        """Returns dict of table name to recorded schema fingerprint"""
+        table = self._fingerprints()
+        try:
+            return dict(table.select(table.table_name, table.fingerprint)
+                .bind(db).tuples())
+        except peewee.DatabaseError:
+            # first start, the table is created with the first fingerprints
+            return {}
+
+    def set_fingerprints(self, db, fingerprints):
+        """Record schema fingerprints, dict of table name to fingerprint"""
+        sql, params = (db.get_sql_context()
+            .literal('CREATE TABLE IF NOT EXISTS ')
+            .sql(peewee.Entity(self.fingerprint_table))
+            .literal(' (table_name VARCHAR(255) NOT NULL PRIMARY KEY, '
+                'fingerprint VARCHAR(64) NOT NULL)')
+            .query())
+        db.execute_sql(sql, params)
+        table = self._fingerprints()
+        names = list(fingerprints)
+        table.delete().where(table.table_name.in_(names)).bind(db).execute()
+        table.insert(list(fingerprints.items()),
+            columns=[table.table_name, table.fingerprint]).bind(db).execute()
+
+    def create_tables(self, force=False):
+        """
+        Create database tables
+
+        Fingerprints of each model's DDL are recorded per database, and
+        models whose fingerprint is unchanged are skipped without any
+        introspection, so a warm start costs one query per database.
+        Existing tables are never altered, a changed model only gets its
+        missing indexes and logs a warning.
+
+        :param force: Create all tables regardless of fingerprints
+        """
+        for db, models in self._by_database():
+            known = {} if force else self.get_fingerprints(db)
+            changed = collections.OrderedDict()
+            for cls in models:
+                name = cls._meta.table_name
+                fingerprint = schema_fingerprint(cls)
+                if known.get(name) == fingerprint:
+                    continue
+                if name in known:
+                    logger.warning(
+                        "Schema of '%s' changed, it may need a migration", name)
+                changed[cls] = fingerprint
+            if not changed:
+                continue
+
+            with db.atomic():
+                for cls in peewee.sort_models(list(changed)):
+                    cls.create_table(safe=True)
+                self.set_fingerprints(db, {cls._meta.table_name: fingerprint
+                    for cls, fingerprint in changed.items()})
 
     def destroy_tables(self):
         """Destroy database tables"""
         for cls in self:
             cls.drop_table(fail_silently=True)
+        for db, models in self._by_database():
+            table = self._fingerprints()
+            names = [cls._meta.table_name for cls in models]
+            try:
+                (table.delete().where(table.table_name.in_(names))
+                    .bind(db).execute())
+            except peewee.DatabaseError:
+                pass
 
     def register(self, model_cls):
         """Register model(s) with app"""
@@ -40,33 +176,344 @@ class ModelManager(list):
 # DB manager
 ####################################################################
 
+def in_event_loop():
+    """Returns True if called from a thread running an asyncio loop"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class ConnectionScope(object):
+    """
+    Connections checked out by `DatabaseManager.connection_context`
+
+    Only connections opened by this scope are released on exit, those
+    which were already open (e.g. by an outer scope) are left alone.
+    Connections are per thread, so only the thread which entered the
+    scope checks out through it, see `DatabaseManager._checkout`.
+    """
+
+    def __init__(self):
+        self.databases = []
+        self.thread = threading.get_ident()
+        self.created = time.time()
+
+    def checkout(self, db):
+        """Connect database if needed, and take ownership of it"""
+        if db.is_closed():
+            db.connect()
+            self.databases.append(db)
+
+    def release(self):
+        """Close all connections owned by this scope"""
+        while self.databases:
+            db = self.databases.pop()
+            if not db.is_closed():
+                db.close()
+
+
 # XXX: improve KeyError message
 class DatabaseManager(dict):
     """Database manager"""
 
+    # max concurrent async calls per database
+    async_workers = 4
+
+    # connect databases on first use rather than in `connect()`
+    lazy_connect = False
+
+    # seconds before idle lazy connections are closed, None to keep open,
+    # see `disconnect_idle`
+    idle_timeout = None
+
+    # `CircuitBreaker` taking unhealthy databases out of routing
+    circuit_breaker = None
+
     def __init__(self):
         self.routers = set()
         self.models = ModelManager(database_manager=self)
+        self._executors = {}
+        self._executors_lock = threading.Lock()
+        self._scope = contextvars.ContextVar(
+            'connection_scope_{}'.format(id(self)), default=None)
+        self._scopes = set()
+        self._scopes_lock = threading.Lock()
+        # (thread, db) to [connection, last used], None once closed
+        self._idle = {}
+        self._idle_lock = threading.Lock()
+        self._reaper = None
+        self._unit_of_work = contextvars.ContextVar(
+            'unit_of_work_{}'.format(id(self)), default=None)
 
     def connect(self):
         """Create connection for all databases"""
+        if self.lazy_connect:
+            return
         for name, connection in self.items():
             connection.connect()
 
     def disconnect(self):
         """Disconnect from all databases"""
+        if self._reaper is not None:
+            self._reaper.set()
+            self._reaper = None
         for name, connection in self.items():
             if not connection.is_closed():
                 connection.close()
 
     def get_database(self, model):
         """Find matching database router"""
+        db = self.resolve_database(model)
+        if db is not None:
+            self._checkout(db)
+            self._prepare_connection(db, model)
+        return db
+
+    def resolve_database(self, model):
+        """Returns database model is routed to, without connecting it"""
+        db = self._route(model)
+        if db is not None and self.circuit_breaker is not None:
+            db = self.circuit_breaker.select(db)
+        return db
+
+    def use_circuit_breaker(self, breaker):
+        """Track health of all databases with `CircuitBreaker`"""
+        if self.circuit_breaker not in (None, breaker):
+            self.circuit_breaker.stop()
+        self.circuit_breaker = breaker
+        for name, db in self.items():
+            breaker.install(name, db)
+
+    def _checkout(self, db):
+        scope = self._scope.get()
+        if scope is not None and scope.thread == threading.get_ident():
+            scope.checkout(db)
+        elif self.lazy_connect:
+            if in_event_loop():
+                # connecting would block the loop, queries built here run
+                # in async workers, which connect in their own threads
+                return
+            self._checkout_lazy(db)
+
+    def _checkout_lazy(self, db):
+        key = (threading.get_ident(), db)
+        now = time.time()
+        with self._idle_lock:
+            entry = self._idle.get(key, ())
+            if entry:
+                # in use again, keep the reaper away
+                entry[1] = now
+        if entry is None and not db.is_closed():
+            # closed by `disconnect_idle` in another thread
+            db._state.reset()
+        if db.is_closed():
+            db.connect()
+        if self.idle_timeout is not None:
+            with self._idle_lock:
+                self._idle[key] = [db.connection(), now]
+            self._start_reaper()
+
+    def _start_reaper(self):
+        with self._idle_lock:
+            if self._reaper is not None:
+                return
+            self._reaper = stop = threading.Event()
+        interval = self.idle_timeout / 2.0
+        def run():
+            while not stop.wait(interval):
+                self.disconnect_idle()
+        thread = threading.Thread(target=run, name='idle-connection-reaper',
+            daemon=True)
+        thread.start()
+
+    def _prepare_connection(self, db, model):
+        if in_event_loop():
+            # statements would block the loop, async workers prepare
+            # their own connections
+            return
+        for router in self.routers:
+            router.prepare_connection(db, model)
+
+    def disconnect_idle(self, now=None):
+        """
+        Close lazy connections of all threads which have not been checked
+        out for longer than `idle_timeout`
+
+        Runs periodically in a reaper thread once a lazy connection was
+        made. Connections of other threads are closed under them and
+        reopened on their next checkout, so a connection used without
+        checkout (e.g. a transaction or bound query left open) for longer
+        than `idle_timeout` may be closed while in use. SQLite connections
+        can only be closed by other threads with `check_same_thread=False`.
+        """
+        if self.idle_timeout is None:
+            return
+        now = time.time() if now is None else now
+        current = threading.get_ident()
+        with self._idle_lock:
+            for key, entry in list(self._idle.items()):
+                if entry is None or now - entry[1] < self.idle_timeout:
+                    continue
+                thread, db = key
+                if thread == current:
+                    if db.in_transaction():
+                        continue
+                    del self._idle[key]
+                    if not db.is_closed():
+                        db.close()
+                    continue
+                try:
+                    db._close(entry[0])
+                except Exception:
+                    logger.debug("Cannot close idle connection of %r", db,
+                        exc_info=True)
+                    continue
+                self._idle[key] = None
+
+    def _route(self, model):
         for router in self.routers:
             r = router.get_database(model)
             if r is not None:
                 return r
         return self.get('default')
 
+    @contextlib.contextmanager
+    def connection_context(self):
+        """
+        Scope connections to the current thread/task
+
+        Unlike `connect()`, databases are only connected when a model
+        routed to them is first used, and are released on exit.
+        """
+        scope = ConnectionScope()
+        token = self._scope.set(scope)
+        with self._scopes_lock:
+            self._scopes.add(scope)
+        try:
+            yield scope
+        finally:
+            self._scope.reset(token)
+            with self._scopes_lock:
+                self._scopes.discard(scope)
+            scope.release()
+
+    @contextlib.contextmanager
+    def unit_of_work(self):
+        """
+        Buffer writes of managed models, flushing them in batches on exit
+
+        Nested calls join the outer unit of work. If the block raises,
+        buffered writes are discarded.
+        """
+        uow = self._unit_of_work.get()
+        if uow is not None:
+            yield uow
+            return
+        uow = UnitOfWork()
+        token = self._unit_of_work.set(uow)
+        try:
+            yield uow
+        finally:
+            self._unit_of_work.reset(token)
+        uow.flush()
+
+    def checkout(self, name):
+        """Return named database, connecting it if lazy or scoped"""
+        db = self[name]
+        self._checkout(db)
+        return db
+
+    def leaked_connections(self, max_age=60):
+        """
+        Returns connection scopes holding connections for longer than
+        `max_age` seconds, which usually means a scope was never exited
+        """
+        cutoff = time.time() - max_age
+        with self._scopes_lock:
+            return [scope for scope in self._scopes
+                if scope.databases and scope.created < cutoff]
+
+    def get_executor(self, db):
+        """
+        Return thread pool used for async calls against database
+
+        Each database gets its own pool, so a slow database cannot starve
+        others, and the pool size bounds concurrency against it. Connections
+        are thread local, so each worker keeps its own open connection.
+        """
+        with self._executors_lock:
+            executor = self._executors.get(db)
+            if executor is None:
+                executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.async_workers)
+                self._executors[db] = executor
+            return executor
+
+    def run_async(self, db, func, *args, **kwargs):
+        """
+        Run blocking call in the database thread pool
+
+        The caller's context is copied into the worker, so routing state
+        selected by the caller still applies.
+
+        :returns: Awaitable future
+        """
+        loop = asyncio.get_event_loop()
+        ctx = contextvars.copy_context()
+        call = functools.partial(ctx.run, func, *args, **kwargs)
+        return loop.run_in_executor(self.get_executor(db), call)
+
+    def _run_on_workers(self, db, func):
+        """Run `func` once on every worker thread of database pool"""
+        barrier = threading.Barrier(self.async_workers)
+        def call():
+            # hold each worker until all are busy, forcing one call per thread
+            barrier.wait()
+            return func()
+        executor = self.get_executor(db)
+        futures = [executor.submit(call) for x in range(self.async_workers)]
+        return asyncio.gather(*[asyncio.wrap_future(f) for f in futures])
+
+    async def aconnect(self):
+        """Create connection for all databases on every async worker"""
+        for name, db in self.items():
+            await self._run_on_workers(
+                db, functools.partial(db.connect, reuse_if_open=True))
+
+    async def adisconnect(self):
+        """Disconnect all async workers and shut down their pools"""
+        def close(db):
+            if not db.is_closed():
+                db.close()
+
+        with self._executors_lock:
+            executors = list(self._executors.items())
+        for db, executor in executors:
+            await self._run_on_workers(db, functools.partial(close, db))
+
+        with self._executors_lock:
+            self._executors.clear()
+        for db, executor in executors:
+            executor.shutdown(wait=False)
+
+    async def aiter(self, query):
+        """
+        Asynchronously iterate over query results
+
+        The query is executed in the database thread pool, so it should
+        be bounded, e.g. by `PrimaryKeyPagination.paginate_query`.
+        """
+        assert isinstance(query, peewee.Query)
+        # connecting here would block the event loop, workers connect
+        db = query._database or self.resolve_database(query.model)
+        def fetch():
+            self._prepare_connection(db, query.model)
+            return list(query)
+        for item in await self.run_async(db, fetch):
+            yield item
+
     def register(self, name, db):
         if isinstance(db, str):
             self[name] = playhouse.db_url.connect(db)
@@ -74,7 +521,512 @@ class DatabaseManager(dict):
             self[name] = db
         else:
             raise ValueError("unexpected 'db' type")
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.install(name, self[name])
+
+
+
+####################################################################
+# Circuit breaker
+####################################################################
+
+class CircuitOpenError(peewee.OperationalError):
+    """Raised when a database and all its alternates are unavailable"""
+
+
+BreakerEvent = collections.namedtuple('BreakerEvent',
+    ['name', 'old_state', 'new_state', 'health'])
+
+
+class DatabaseHealth(object):
+    """Health of one database, see `CircuitBreaker`"""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = CircuitBreaker.CLOSED
+        self.latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.errors = 0
+        self.opened_at = None
+        self.last_probe = None
+
+    def as_dict(self):
+        return {'state': self.state, 'latency': self.latency,
+            'error_rate': self.error_rate, 'calls': self.calls,
+            'errors': self.errors, 'opened_at': self.opened_at}
+
+
+class CircuitBreaker(object):
+    """
+    Track database health and take unhealthy databases out of routing
+
+    Installed with `DatabaseManager.use_circuit_breaker`. Latency and
+    errors of every statement are tracked as exponentially weighted
+    moving averages; only errors accepted by `is_failure`, i.e. lost
+    connections and timeouts, count as failures. Once `min_calls` statements
+    were seen, a database whose error rate reaches `max_error_rate`, or
+    whose latency exceeds `max_latency`, is opened: routing falls back
+    to its `alternates`, or raises `CircuitOpenError` if none are
+    available.
+
+    After `reset_timeout` seconds an open database is half open, the next
+    statement decides whether it is closed again or re-opened. Probes
+    (see `probe` and `start`) close it as soon as a probe succeeds.
+
+    State changes are logged and passed to each `listeners` callable as
+    `BreakerEvent`, `metrics()` returns current health of all databases.
+
+    :attr alternates: Dict of database name to list of fallback names
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # driver error codes counted as failures, see `is_failure`
+    failure_codes = {
+        # SQLITE_BUSY, SQLITE_LOCKED, SQLITE_IOERR, SQLITE_CANTOPEN
+        'sqlite': {5, 6, 10, 14},
+        # too many connections, lock wait timeout, can't connect, server
+        # gone away, lost connection, max execution time exceeded
+        'mysql': {1040, 1205, 2002, 2003, 2006, 2013, 3024},
+        # SQLSTATE classes connection exception, insufficient resources
+        # and operator intervention (incl. statement timeout)
+        'postgres': {'08', '53', '57'},
+    }
+    sqlite_failure_messages = ('database is locked', 'database table is '
+        'locked', 'disk I/O error', 'unable to open database')
+
+    def __init__(self, alternates=None, max_error_rate=0.5, max_latency=None,
+                 min_calls=10, alpha=0.2, reset_timeout=30,
+                 probe_sql='SELECT 1'):
+        self.alternates = alternates or {}
+        self.max_error_rate = max_error_rate
+        self.max_latency = max_latency
+        self.min_calls = min_calls
+        self.alpha = alpha
+        self.reset_timeout = reset_timeout
+        self.probe_sql = probe_sql
+        self.listeners = []
+        self.databases = {}
+        self._health = {}
+        self._lock = threading.Lock()
+        self._stop = None
+
+    def install(self, name, db):
+        """Track statements and connects of database"""
+        if db in self._health:
+            return
+        self.databases[name] = db
+        self._health[db] = DatabaseHealth(name)
+
+        # methods are wrapped once, the breaker installed last records
+        wrapped = '_circuit_breaker' in db.__dict__
+        db._circuit_breaker = self
+        if wrapped:
+            return
+
+        def tracked(method):
+            @functools.wraps(method)
+            def call(*args, **kwargs):
+                start = time.monotonic()
+                try:
+                    result = method(*args, **kwargs)
+                except Exception as exc:
+                    breaker = db._circuit_breaker
+                    if breaker.is_failure(exc):
+                        breaker.record(db, time.monotonic() - start,
+                            error=True)
+                    raise
+                db._circuit_breaker.record(db, time.monotonic() - start)
+                return result
+            return call
+
+        db.execute_sql = tracked(db.execute_sql)
+        db.connect = tracked(db.connect)
+
+    def is_failure(self, exc):
+        """
+        Returns True if error counts against health of its database
+
+        Lost connections, timeouts and other driver errors listed in
+        `failure_codes` are failures, errors caused by the statement
+        itself (e.g. missing table or constraint violation) or raised by
+        peewee rather than the driver are not.
+        """
+        if isinstance(exc, peewee.InterfaceError):
+            return True
+        if not isinstance(exc, peewee.OperationalError):
+            return False
+        orig = getattr(exc, 'orig', None)
+        if orig is None:
+            # raised by peewee itself, e.g. connection already opened
+            return False
+        if hasattr(orig, 'pgcode'):
+            # no code when there was no server to answer
+            return (orig.pgcode is None or
+                orig.pgcode[:2] in self.failure_codes['postgres'])
+        if type(orig).__module__.startswith(('sqlite3', 'pysqlite')):
+            code = getattr(orig, 'sqlite_errorcode', None)
+            if code is not None:
+                # extended codes keep the primary code in the low byte
+                return code & 0xff in self.failure_codes['sqlite']
+            return str(orig).startswith(self.sqlite_failure_messages)
+        if orig.args and isinstance(orig.args[0], int):
+            return orig.args[0] in self.failure_codes['mysql']
+        return True
+
+    def health(self, db):
+        """Returns `DatabaseHealth` of database"""
+        return self._health[db]
+
+    def metrics(self):
+        """Returns dict of database name to health metrics"""
+        with self._lock:
+            return {h.name: h.as_dict() for h in self._health.values()}
+
+    def _set_state(self, health, state, now):
+        # called with lock held, returns event to emit
+        if health.state == state:
+            return None
+        event = BreakerEvent(health.name, health.state, state, health)
+        health.state = state
+        if state == self.OPEN:
+            health.opened_at = now
+        elif state == self.CLOSED:
+            health.opened_at = None
+            health.calls = health.errors = 0
+            health.error_rate = 0.0
+        return event
+
+    def _emit(self, event):
+        if event is None:
+            return
+        log = logger.warning if event.new_state == self.OPEN else logger.info
+        log("Database '%s' circuit %s -> %s",
+            event.name, event.old_state, event.new_state)
+        for listener in self.listeners:
+            listener(event)
+
+    def record(self, db, latency, error=False):
+        """Record outcome of a call against database"""
+        health = self._health.get(db)
+        if health is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            health.calls += 1
+            health.errors += bool(error)
+            # plain mean until there are enough calls for the average
+            alpha = max(self.alpha, 1.0 / health.calls)
+            health.error_rate += alpha * (float(error) - health.error_rate)
+            if not error:
+                if health.latency is None:
+                    health.latency = latency
+                else:
+                    health.latency += alpha * (latency - health.latency)
+
+            if health.state == self.HALF_OPEN:
+                state = self.OPEN if error else self.CLOSED
+            elif health.calls < self.min_calls:
+                state = health.state
+            elif health.error_rate >= self.max_error_rate or (
+                    self.max_latency is not None and
+                    health.latency is not None and
+                    health.latency > self.max_latency):
+                state = self.OPEN
+            else:
+                state = health.state
+            event = self._set_state(health, state, now)
+        self._emit(event)
+
+    def available(self, db):
+        """Returns True if calls may be made against database"""
+        health = self._health.get(db)
+        if health is None or health.state != self.OPEN:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            if health.state != self.OPEN:
+                return True
+            if now - health.opened_at < self.reset_timeout:
+                return False
+            event = self._set_state(health, self.HALF_OPEN, now)
+        self._emit(event)
+        return True
+
+    def select(self, db):
+        """Returns database, or first available alternate"""
+        if self.available(db):
+            return db
+        name = self._health[db].name
+        for alternate in self.alternates.get(name, ()):
+            candidate = self.databases[alternate]
+            if self.available(candidate):
+                return candidate
+        raise CircuitOpenError(
+            "Database '{}' and its alternates are unavailable".format(name))
+
+    def probe(self, db):
+        """
+        Run probe statement against database on its own connection,
+        closing the circuit if it succeeds
+
+        :returns: True if healthy
+        """
+        health = self._health[db]
+        health.last_probe = time.monotonic()
+        opened = db.is_closed()
+        try:
+            if opened:
+                db.connect()
+            db.execute_sql(self.probe_sql).fetchall()
+        except (peewee.OperationalError, peewee.InterfaceError):
+            return False
+        finally:
+            if opened and not db.is_closed():
+                db.close()
+        with self._lock:
+            event = self._set_state(health, self.CLOSED, time.monotonic())
+        self._emit(event)
+        return True
+
+    def probe_open(self):
+        """Probe all open databases, returns names of recovered ones"""
+        return [h.name for db, h in list(self._health.items())
+            if h.state != self.CLOSED and self.probe(db)]
 
+    def start(self, interval=10):
+        """Probe open databases every `interval` seconds in a thread"""
+        self.stop()
+        self._stop = stop = threading.Event()
+        def run():
+            while not stop.wait(interval):
+                self.probe_open()
+        thread = threading.Thread(target=run, name='circuit-breaker-probe',
+            daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """Stop probe thread"""
+        if self._stop is not None:
+            self._stop.set()
+            self._stop = None
+
+
+####################################################################
+# Unit of work
+####################################################################
+
+class UnitOfWork(object):
+    """
+    Buffer of model writes, flushed as batched statements
+
+    Created by `DatabaseManager.unit_of_work`. While active, `save()` and
+    `delete_instance()` of managed models are buffered instead of being
+    executed. On flush writes are grouped per routed database and model
+    and run in one transaction per database: inserts as multi-row INSERTs
+    with parents first, updates as CASE UPDATEs, then deletes with
+    children first.
+
+    Buffered writes are not visible to queries until flushed, and auto
+    increment keys are only assigned on flush.
+    """
+
+    # max rows per statement
+    batch_size = 100
+
+    def __init__(self):
+        self.paused = False
+        self._reset()
+
+    def _reset(self):
+        # keyed by id(), model instances without pk compare equal
+        self.inserts = collections.OrderedDict()
+        self.updates = collections.OrderedDict()
+        self.deletes = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.inserts) + len(self.updates) + len(self.deletes)
+
+    def add(self, instance, force_insert=False, only=None):
+        """Buffer `instance.save()`"""
+        meta = instance._meta
+        key = id(instance)
+        if key in self.inserts:
+            # inserted with its final values on flush
+            return 1
+        if force_insert or meta.primary_key is False or instance._pk is None:
+            self.deletes.pop(key, None)
+            self.inserts[key] = (meta.database, instance)
+            return 1
+
+        if only is not None:
+            fields = [meta.fields[f] if isinstance(f, str) else f
+                for f in only]
+        elif meta.only_save_dirty:
+            fields = instance.dirty_fields
+        else:
+            fields = meta.sorted_fields
+        pk_names = set(f.name for f in meta.get_primary_keys())
+        names = set(f.name for f in fields) - pk_names
+        if not names:
+            instance._dirty.clear()
+            return False
+        entry = self.updates.setdefault(key, (meta.database, instance, set()))
+        entry[2].update(names)
+        return 1
+
+    def delete(self, instance):
+        """Buffer `instance.delete_instance()`"""
+        key = id(instance)
+        self.updates.pop(key, None)
+        if self.inserts.pop(key, None) is None:
+            self.deletes[key] = (instance._meta.database, instance)
+        return 1
+
+    @contextlib.contextmanager
+    def suspended(self):
+        """Flush and execute writes directly within block"""
+        self.flush()
+        paused, self.paused = self.paused, True
+        try:
+            yield
+        finally:
+            self.paused = paused
+
+    def flush(self):
+        """Execute buffered writes, one transaction per database"""
+        inserts, updates, deletes = self.inserts, self.updates, self.deletes
+        self._reset()
+        dbs = unique(entry[0] for entry in itertools.chain(
+            inserts.values(), updates.values(), deletes.values()))
+        for db in dbs:
+            with db.atomic():
+                self._flush_inserts(db, [instance
+                    for d, instance in inserts.values() if d is db])
+                self._flush_updates(db, [(instance, names)
+                    for d, instance, names in updates.values() if d is db])
+                self._flush_deletes(db, [instance
+                    for d, instance in deletes.values() if d is db])
+
+    def _by_model(self, items, key=lambda item: item):
+        groups = collections.OrderedDict()
+        for item in items:
+            groups.setdefault(type(key(item)), []).append(item)
+        return [(model, groups[model])
+            for model in peewee.sort_models(list(groups))]
+
+    def _flush_inserts(self, db, instances):
+        for model, instances in self._by_model(instances):
+            # rows referencing unsaved rows of the same model wait until
+            # those are inserted and their keys are known
+            fks = [fk for fk, rel in model._meta.refs.items() if rel is model]
+            while instances:
+                pending = set(map(id, instances))
+                ready = [instance for instance in instances if not any(
+                    id(instance.__rel__.get(fk.name)) in pending
+                    for fk in fks)]
+                if not ready:
+                    # reference cycle, set the keys once all are inserted
+                    self._insert_rows(db, model, instances)
+                    for instance in instances:
+                        data = {fk: instance.__rel__[fk.name]._pk
+                            for fk in fks
+                            if id(instance.__rel__.get(fk.name)) in pending}
+                        (model.update(data).where(instance._pk_expr())
+                            .bind(db).execute())
+                    break
+                self._insert_rows(db, model, ready)
+                done = set(map(id, ready))
+                instances = [instance for instance in instances
+                    if id(instance) not in done]
+
+    def _insert_rows(self, db, model, instances):
+        groups = collections.OrderedDict()
+        for instance in instances:
+            data = instance.__data__.copy()
+            # parents were inserted first, pick up their keys
+            instance._populate_unsaved_relations(data)
+            auto = model._meta.auto_increment and instance._pk is None
+            if auto:
+                data.pop(model._meta.primary_key.name, None)
+            key = (auto, tuple(sorted(data)))
+            groups.setdefault(key, []).append((instance, data))
+
+        for (auto, columns), items in groups.items():
+            for batch in peewee.chunked(items, self.batch_size):
+                self._insert(db, model, batch, auto)
+
+    def _insert(self, db, model, batch, auto):
+        query = model.insert_many([data for instance, data in batch]).bind(db)
+        if not batch[0][1]:
+            # no columns to list, insert each row with DEFAULT VALUES
+            ids = [model.insert().bind(db).execute() for item in batch]
+            if not auto:
+                ids = None
+        elif not auto:
+            query.execute()
+            ids = None
+        elif db.returning_clause:
+            query = query.returning(model._meta.primary_key).tuples()
+            ids = [row[0] for row in query.execute()]
+        elif isinstance(db, peewee.SqliteDatabase):
+            # single writer, rows of one statement get consecutive ids
+            last = db.execute(query).lastrowid
+            ids = range(last - len(batch) + 1, last + 1)
+        else:
+            ids = [model.insert(data).bind(db).execute()
+                for instance, data in batch]
+
+        for i, (instance, data) in enumerate(batch):
+            if ids is not None:
+                instance._pk = ids[i]
+            instance._dirty.clear()
+
+    def _flush_updates(self, db, items):
+        groups = collections.OrderedDict()
+        for instance, names in items:
+            key = (type(instance), tuple(sorted(names)))
+            groups.setdefault(key, []).append(instance)
+
+        models = peewee.sort_models(list(set(m for m, n in groups)))
+        for (model, names), instances in sorted(groups.items(),
+                key=lambda item: models.index(item[0][0])):
+            fields = [model._meta.fields[name] for name in names]
+            if model._meta.composite_key:
+                for instance in instances:
+                    data = {f: instance.__data__.get(f.name) for f in fields}
+                    (model.update(data).where(instance._pk_expr())
+                        .bind(db).execute())
+            else:
+                pk = model._meta.primary_key
+                for batch in peewee.chunked(instances, self.batch_size):
+                    data = {}
+                    for field in fields:
+                        data[field] = peewee.Case(pk, [
+                            (pk.to_value(instance._pk),
+                             field.to_value(instance.__data__.get(field.name)))
+                            for instance in batch])
+                    (model.update(data)
+                        .where(pk.in_([instance._pk for instance in batch]))
+                        .bind(db).execute())
+            for instance in instances:
+                instance._dirty -= set(names)
+
+    def _flush_deletes(self, db, instances):
+        for model, instances in reversed(self._by_model(instances)):
+            if model._meta.composite_key:
+                for instance in instances:
+                    model.delete().where(instance._pk_expr()).bind(db).execute()
+                continue
+            pk = model._meta.primary_key
+            for batch in peewee.chunked(instances, self.batch_size):
+                (model.delete()
+                    .where(pk.in_([instance._pk for instance in batch]))
+                    .bind(db).execute())
 
 
 ####################################################################
@@ -85,107 +1037,2047 @@ class DatabaseRouter(object):
     def get_database(self, model):
         return None
 
+    def prepare_connection(self, db, model):
+        """
+        Prepare connection of database selected for model
+
+        Called after `get_database` and health checks each time the model
+        is routed outside of the event loop, e.g. on every `_meta.database`
+        access, so it should return quickly when there is nothing to do.
+        """
+        pass
+
 
 ####################################################################
-# Model
+# Sharding
 ####################################################################
 
+class ShardingStrategy(object):
+    """Maps a shard key value onto a shard (database) name"""
 
-class Metadata(peewee.Metadata):
-    _database = None
+    @property
+    def shards(self):
+        """Returns list of every shard name this strategy can select"""
+        raise NotImplementedError
+
+    def get_shard(self, value):
+        raise NotImplementedError
+
+
+class HashShardingStrategy(ShardingStrategy):
+    """
+    Spread shard keys evenly across shards
+
+    Uses crc32 rather than `hash()` so shard selection is stable
+    across processes and interpreter restarts.
+    """
+
+    def __init__(self, shards):
+        assert shards, "expected at least one shard"
+        self._shards = list(shards)
 
     @property
-    def database(self):
-        if isinstance(self._database, DatabaseManager):
-            db = self._database.get_database(self)
-            if db: return db
-        return self._database
+    def shards(self):
+        return list(self._shards)
 
-    @database.setter
-    def database(self, value):
-        self._database = value
+    def get_shard(self, value):
+        if value is None:
+            raise ValueError("Cannot hash shard key 'None'")
+        checksum = zlib.crc32(str(value).encode('utf-8')) & 0xffffffff
+        return self._shards[checksum % len(self._shards)]
+
+
+class RangeShardingStrategy(ShardingStrategy):
+    """
+    Assign shard keys by range
+
+    :attr ranges: List of tuples (upper_bound, shard), upper bounds are
+        exclusive and the final bound may be `None` for unbounded, e.g.
+        [(1000, 'shard1'), (None, 'shard2')]
+    """
+
+    def __init__(self, ranges):
+        assert ranges, "expected at least one range"
+        bounds = [bound for bound, shard in ranges]
+        if None in bounds[:-1]:
+            raise ValueError("Only the final range may be unbounded")
+        finite = [b for b in bounds if b is not None]
+        if finite != sorted(finite):
+            raise ValueError("Range bounds must be in ascending order")
+        self._bounds = finite
+        self._ranges = list(ranges)
+
+    @property
+    def shards(self):
+        return unique([shard for bound, shard in self._ranges])
+
+    def get_shard(self, value):
+        idx = bisect.bisect_right(self._bounds, value)
+        if idx >= len(self._ranges):
+            raise ValueError(
+                "Shard key '{}' is outside all ranges".format(value))
+        return self._ranges[idx][1]
+
+
+class LookupShardingStrategy(ShardingStrategy):
+    """
+    Assign shard keys from a lookup table
+
+    :attr table: Dict or callable mapping shard key to shard name
+    :attr shards: Shard names, required when `table` is callable
+    :attr default: Shard used for keys missing from the table
+    """
+
+    def __init__(self, table, shards=None, default=None):
+        if shards is None:
+            assert not callable(table), "expected 'shards' for callable table"
+            shards = list(table.values())
+            if default is not None:
+                shards.append(default)
+        self.table = table
+        self.default = default
+        self._shards = unique(shards)
+
+    @property
+    def shards(self):
+        return list(self._shards)
+
+    def get_shard(self, value):
+        if callable(self.table):
+            shard = self.table(value)
+        else:
+            shard = self.table.get(value)
+        if shard is None:
+            shard = self.default
+        if shard is None:
+            raise ValueError("No shard found for key '{}'".format(value))
+        return shard
+
+
+class ShardRouter(DatabaseRouter):
+    """
+    Route models across several databases by the value of a shard key
+
+    The model class alone cannot tell us which shard to use, so the
+    shard is selected for the current context with `using()` (by shard
+    key) or `using_shard()` (by shard name). Outside of these contexts
+    the router does not match and routing falls through as normal.
+
+    Queries can be executed with `execute()`, which inspects the query
+    predicates for the shard key and only touches matching shards.
+    Queries without a usable shard key are scattered to every shard
+    and the ordered results merged, so keyset pagination still works.
+    The primary key tiebreaker of `PrimaryKeyPagination` only gives a
+    correct keyset across shards if keys are unique across all shards
+    (e.g. `UUID7Field`), not with per shard auto increment ids.
+    """
+
+    def __init__(self, dbm, models, shard_key, strategy):
+        assert isinstance(dbm, DatabaseManager)
+        assert isinstance(shard_key, str)
+        assert isinstance(strategy, ShardingStrategy)
+        self.dbm = dbm
+        self.models = set(models)
+        self.shard_key = shard_key
+        self.strategy = strategy
+        self._shard = contextvars.ContextVar(
+            'shard_router_{}'.format(id(self)), default=None)
+
+    @property
+    def current_shard(self):
+        """Returns name of shard selected for the current context"""
+        return self._shard.get()
+
+    def get_database(self, model):
+        if model in self.models and self.current_shard is not None:
+            return self.dbm[self.current_shard]
+        return None
+
+    @contextlib.contextmanager
+    def using_shard(self, name):
+        """Route sharded models to named shard within context"""
+        if name not in self.dbm:
+            raise KeyError("Shard '{}' is not a registered database".format(name))
+        token = self._shard.set(name)
+        try:
+            yield self.dbm[name]
+        finally:
+            self._shard.reset(token)
+
+    def using(self, value):
+        """Route sharded models by shard key value within context"""
+        return self.using_shard(self.strategy.get_shard(value))
+
+    def get_shard_for_instance(self, instance):
+        """Returns shard name for model instance"""
+        # raw column value, as in queries, rather than a related instance
+        field = instance._meta.fields[self.shard_key]
+        return self.strategy.get_shard(instance.__data__.get(field.name))
+
+    def save(self, instance, **kwargs):
+        """Save model instance to the shard selected by its data"""
+        with self.using_shard(self.get_shard_for_instance(instance)):
+            return instance.save(**kwargs)
+
+    def get_shards_for_query(self, query):
+        """
+        Returns list of shard names which may hold rows for query
+
+        Only equality and IN predicates on the shard key (combined with
+        AND/OR) are understood, anything else targets every shard.
+        """
+        assert isinstance(query, peewee.Query)
+        shards = self._shards_for_node(query._where)
+        if shards is None:
+            return self.strategy.shards
+        return [name for name in self.strategy.shards if name in shards]
+
+    def _shards_for_node(self, node):
+        if not isinstance(node, peewee.Expression):
+            return None
+
+        op = node.op
+        if op == peewee.OP.AND:
+            lhs = self._shards_for_node(node.lhs)
+            rhs = self._shards_for_node(node.rhs)
+            if lhs is None or rhs is None:
+                return lhs if rhs is None else rhs
+            return lhs & rhs
+
+        if op == peewee.OP.OR:
+            lhs = self._shards_for_node(node.lhs)
+            rhs = self._shards_for_node(node.rhs)
+            if lhs is None or rhs is None:
+                return None
+            return lhs | rhs
+
+        if not self._is_shard_key(node.lhs):
+            return None
+        if op == peewee.OP.EQ:
+            values = [node.rhs]
+        elif op == peewee.OP.IN and isinstance(node.rhs, (list, set, tuple)):
+            values = node.rhs
+        else:
+            return None
+        # columns, subqueries etc are only known to the database
+        if any(isinstance(value, peewee.Node) for value in values):
+            return None
+        return set(shard for shard in map(self._get_shard, values)
+            if shard is not None)
+
+    def _get_shard(self, value):
+        try:
+            return self.strategy.get_shard(value)
+        except ValueError:
+            # key no shard holds, e.g. missing from lookup table
+            return None
+
+    def _is_shard_key(self, node):
+        return (isinstance(node, peewee.Field) and
+            node.model in self.models and node.name == self.shard_key)
+
+    def execute(self, query):
+        """
+        Execute select query against matching shard(s)
+
+        :attr query: Instance of `peewee.Query`
+
+        :returns: List of rows, ordered and limited as the query asks
+        """
+        shards = self.get_shards_for_query(query)
+        if len(shards) == 1:
+            return list(query.clone().bind(self.dbm.checkout(shards[0])))
+
+        # each shard must return enough rows to satisfy offset+limit
+        offset = query._offset or 0
+        limit = query._limit
+        shard_query = query.clone()
+        if limit is not None:
+            shard_query = shard_query.limit(offset + limit)
+        shard_query = shard_query.offset(None)
+
+        results = [shard_query.clone().bind(self.dbm.checkout(name))
+            for name in shards]
+        key = order_key(query._order_by,
+            nulls_last=isinstance(self.dbm[shards[0]],
+                peewee.PostgresqlDatabase))
+        rows = heapq.merge(*results, key=key) if key else itertools.chain(*results)
+        stop = None if limit is None else offset + limit
+        return list(itertools.islice(rows, offset, stop))
+
+    def create_tables(self):
+        """Create sharded model tables on every shard"""
+        for name in self.strategy.shards:
+            with self.using_shard(name):
+                for model in peewee.sort_models(self.models):
+                    model.create_table(safe=True)
+
+
+@functools.total_ordering
+class _Descending(object):
+    """Inverts comparison of wrapped value for descending merges"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def order_key(order_by, nulls_last=False):
+    """
+    Returns sort key function for rows matching `order_by` nodes
+
+    Used to merge already ordered result sets, returns `None` if
+    the ordering cannot be reproduced in Python.
+
+    NULLs sort before other values in ascending order, as on SQLite and
+    MySQL, pass `nulls_last` for Postgres where they sort after. Explicit
+    `nulls` of an ordering take precedence.
+    """
+    if not order_by:
+        return None
+
+    getters = []
+    for node in order_by:
+        descending = False
+        nulls_first = not nulls_last
+        if isinstance(node, peewee.Ordering):
+            descending = node.direction.lower() == 'desc'
+            nulls_first = nulls_first != descending
+            if node.nulls:
+                nulls_first = node.nulls.lower() == 'first'
+            node = node.node
+        if isinstance(node, peewee.Field):
+            name = node.name
+        elif isinstance(node, peewee.SQL):
+            name = node.sql
+        else:
+            return None
+        getters.append((name, descending, 0 if nulls_first else 2))
+
+    def key(row):
+        values = []
+        for name, descending, null_rank in getters:
+            if isinstance(row, dict):
+                value = row[name]
+            elif isinstance(row, peewee.Model) and name in row.__data__:
+                # column value rather than related instance
+                value = row.__data__[name]
+            else:
+                value = getattr(row, name)
+            if value is None:
+                # NULLs never compare with values, only their position
+                values.append((null_rank, None))
+            else:
+                values.append((1, _Descending(value) if descending else value))
+        return tuple(values)
+    return key
+
+
+def unique(items):
+    """Returns list of items with duplicates removed, preserving order"""
+    seen = set()
+    return [x for x in items if not (x in seen or seen.add(x))]
+
+
+####################################################################
+# Tenants
+####################################################################
+
+class TenantRouter(DatabaseRouter):
+    """
+    Route models to one schema per tenant of shared databases
+
+    Rather than a database object, and so a connection pool, per tenant,
+    tenants share the connections of their physical database (see
+    `get_database_name`). The tenant is selected for the current context
+    with `using()`, and the connection switched to the tenant schema
+    with `SET search_path` on Postgres or `USE` on MySQL. The schema is
+    checked each time a model is routed (see `prepare_connection`), after
+    health checks (see `CircuitBreaker`), so it is set on the database
+    actually used. The check connects the database like any query would.
+    The schema of each connection is remembered, so the switch statement
+    only runs when the connection is not already on the right tenant. Outside of `using()`, and for models not routed by this
+    router, the connection is switched back to the default schema.
+
+    Switches made inside a transaction are undone by a rollback, so they
+    are only remembered until the transaction ends.
+
+    Tables of each tenant are looked up once and cached, see
+    `table_exists` and `create_tables`.
+    """
+
+    tenant_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+    def __init__(self, dbm, models, database='default'):
+        assert isinstance(dbm, DatabaseManager)
+        self.dbm = dbm
+        self.models = set(models)
+        self.database = database
+        self._tenant = contextvars.ContextVar(
+            'tenant_router_{}'.format(id(self)), default=None)
+        # schema each connection is switched to
+        self._schemas = weakref.WeakKeyDictionary()
+        self._databases = set()
+        self._tables = {}
+        self._tables_lock = threading.Lock()
+
+    @property
+    def current_tenant(self):
+        """Returns tenant selected for the current context"""
+        return self._tenant.get()
+
+    def get_database_name(self, tenant):
+        """Returns name of database holding tenant schema"""
+        return self.database
+
+    def get_database(self, model):
+        if model not in self.models:
+            return None
+        tenant = self.current_tenant
+        name = self.database if tenant is None else (
+            self.get_database_name(tenant))
+        return self.dbm[name]
+
+    def prepare_connection(self, db, model):
+        if model in self.models:
+            self.switch(db, self.current_tenant)
+        elif db in self._databases and not db.is_closed():
+            # `USE` changes the database of every model, and tenant tables
+            # can shadow shared ones on the search path
+            current = self._schemas.get(db.connection())
+            if current is not None and current[0] is not None:
+                self.switch(db, None)
+
+    @contextlib.contextmanager
+    def using(self, tenant):
+        """Route tenant models to tenant schema within context"""
+        if not self.tenant_re.match(tenant):
+            raise ValueError("Invalid tenant name '{}'".format(tenant))
+        token = self._tenant.set(tenant)
+        try:
+            yield self.dbm[self.get_database_name(tenant)]
+        finally:
+            self._tenant.reset(token)
+
+    def _quote(self, db, name):
+        return db.get_sql_context().sql(peewee.Entity(name)).query()[0]
+
+    def get_switch_sql(self, db, tenant):
+        """Returns SQL switching connection to tenant, None is default"""
+        if isinstance(db, peewee.PostgresqlDatabase):
+            if tenant is None:
+                return 'SET search_path TO DEFAULT'
+            return 'SET search_path TO {}, public'.format(
+                self._quote(db, tenant))
+        if isinstance(db, peewee.MySQLDatabase):
+            return 'USE {}'.format(self._quote(db, tenant or db.database))
+        raise NotImplementedError(
+            "Schema per tenant is not supported by {}".format(
+                type(db).__name__))
+
+    def get_create_sql(self, db, tenant):
+        """Returns SQL creating tenant schema"""
+        if isinstance(db, peewee.PostgresqlDatabase):
+            return 'CREATE SCHEMA IF NOT EXISTS {}'.format(
+                self._quote(db, tenant))
+        if isinstance(db, peewee.MySQLDatabase):
+            return 'CREATE DATABASE IF NOT EXISTS {}'.format(
+                self._quote(db, tenant))
+        raise NotImplementedError(
+            "Schema per tenant is not supported by {}".format(
+                type(db).__name__))
+
+    def switch(self, db, tenant):
+        """Switch current connection of database to tenant schema"""
+        self.dbm._checkout(db)
+        conn = db.connection()
+        transactions = db._state.transactions
+        current = self._schemas.get(conn)
+        if current is not None and current[0] == tenant and (
+                current[1] is None or current[1] in transactions):
+            return
+        db.execute_sql(self.get_switch_sql(db, tenant))
+        self._databases.add(db)
+        # remember transaction the switch is undone with on rollback
+        self._schemas[conn] = (tenant,
+            transactions[-1] if transactions else None)
+
+    def get_tables(self, db, tenant):
+        """Returns set of tables in tenant schema, cached"""
+        key = (db, tenant)
+        tables = self._tables.get(key)
+        if tables is None:
+            if isinstance(db, peewee.MySQLDatabase):
+                # `get_tables` ignores schema on MySQL
+                cursor = db.execute_sql('SELECT table_name FROM '
+                    'information_schema.tables WHERE table_schema = %s',
+                    (tenant or db.database,))
+                tables = set(row[0] for row in cursor.fetchall())
+            else:
+                tables = set(db.get_tables(schema=tenant))
+            with self._tables_lock:
+                self._tables[key] = tables
+        return tables
+
+    def table_exists(self, model, tenant=None):
+        """Returns True if model table exists in tenant schema"""
+        tenant = tenant or self.current_tenant
+        db = self.dbm[self.get_database_name(tenant)]
+        return model._meta.table_name in self.get_tables(db, tenant)
+
+    def create_tables(self, tenant):
+        """Create tenant schema and any missing tables in it"""
+        with self.using(tenant) as db:
+            missing = [model for model in peewee.sort_models(self.models)
+                if not self.table_exists(model, tenant)]
+            if not missing:
+                return []
+            db.execute_sql(self.get_create_sql(db, tenant))
+            for model in missing:
+                model.create_table(safe=True)
+            created = set(model._meta.table_name for model in missing)
+            with self._tables_lock:
+                key = (db, tenant)
+                self._tables[key] = self._tables.get(key, set()) | created
+            return missing
+
+
+####################################################################
+# Model
+####################################################################
+
+
+class Metadata(peewee.Metadata):
+    _database = None
+
+    @property
+    def database(self):
+        if isinstance(self._database, DatabaseManager):
+            db = self._database.get_database(self.model)
+            if db: return db
+        return self._database
+
+    @database.setter
+    def database(self, value):
+        self._database = value
+
+    @property
+    def unit_of_work(self):
+        """Active `UnitOfWork` buffering writes of this model, if any"""
+        if isinstance(self._database, DatabaseManager):
+            uow = self._database._unit_of_work.get()
+            if uow is not None and not uow.paused:
+                return uow
+        return None
+
+
+class Model(peewee.Model):
+    """Custom model"""
+
+    class Meta:
+        model_metadata_class = Metadata
+
+    def save(self, force_insert=False, only=None):
+        uow = self._meta.unit_of_work
+        if uow is not None:
+            return uow.add(self, force_insert=force_insert, only=only)
+        return super(Model, self).save(force_insert=force_insert, only=only)
+
+    def delete_instance(self, recursive=False, delete_nullable=False):
+        uow = self._meta.unit_of_work
+        if uow is not None and not recursive:
+            return uow.delete(self)
+        return super(Model, self).delete_instance(
+            recursive=recursive, delete_nullable=delete_nullable)
+
+    def update_instance(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+        self.save()
+
+    @classmethod
+    def select(cls, *fields):
+        is_default = not fields
+        if not fields:
+            fields = cls._meta.sorted_fields
+        return LazyModelSelect(cls, fields, is_default=is_default)
+
+    @classmethod
+    def create_or_get(self, **kwargs):
+        uow = self._meta.unit_of_work
+        if uow is not None:
+            # existing rows can only be found by hitting the database
+            with uow.suspended():
+                return self.create_or_get(**kwargs)
+        with self.atomic():
+            try:
+                return self.create(**kwargs), True
+            except peewee.IntegrityError:
+                return self.get(**kwargs), False
+
+    @classmethod
+    def get_or_none(cls, **kwargs):
+        """
+        XXX: needs unit test
+        """
+        try:
+            return cls.get(**kwargs)
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def atomic(self):
+        """Shortcut method for creating atomic context"""
+        return self._meta.database.atomic()
+
+    @classmethod
+    def run_async(cls, func, *args, **kwargs):
+        """Run blocking call in the thread pool of our routed database"""
+        dbm = cls._meta._database
+        if not isinstance(dbm, DatabaseManager):
+            raise RuntimeError(
+                "Async calls require model registered with DatabaseManager")
+        # resolve without connecting, which would block the event loop
+        db = dbm.resolve_database(cls)
+        return dbm.run_async(db, func, *args, **kwargs)
+
+    @classmethod
+    async def aget(cls, *query, **kwargs):
+        """Async version of `get`"""
+        return await cls.run_async(cls.get, *query, **kwargs)
+
+    @classmethod
+    async def aget_or_none(cls, **kwargs):
+        """Async version of `get_or_none`"""
+        return await cls.run_async(cls.get_or_none, **kwargs)
+
+    @classmethod
+    async def acreate(cls, **kwargs):
+        """Async version of `create`"""
+        return await cls.run_async(cls.create, **kwargs)
+
+    @classmethod
+    async def acreate_or_get(cls, **kwargs):
+        """Async version of `create_or_get`"""
+        return await cls.run_async(cls.create_or_get, **kwargs)
+
+    async def asave(self, **kwargs):
+        """Async version of `save`"""
+        return await self.run_async(self.save, **kwargs)
+    
+    def to_cursor_ref(self):
+        """Returns dict of values to uniquely reference this item"""
+        fields = self._meta.get_primary_keys()
+        assert fields
+        values = {field.name:self.__data__[field.name] for field in fields}
+        return values
+
+    @classmethod
+    def from_cursor_ref(self, cursor):
+        """Returns model instance from unique cursor reference"""
+        return self.get(**cursor)
+
+    def refetch(self):
+        """
+        Return new model instance with fresh data from database
+        Only works on models which have a primary or compound key
+        See https://github.com/coleifer/peewee/issues/638
+
+        XXX: Add support for models without PK
+        """
+        ref = self.to_cursor_ref()
+        return self.from_cursor_ref(ref)
+
+    @classmethod
+    def record_class(cls):
+        """Returns read-only `Record` class for this model, see `Record`"""
+        # look in own __dict__ so subclasses get their own record class
+        record_cls = cls.__dict__.get('_record_class')
+        if record_cls is None:
+            clashes = [name for name in cls._meta.fields if hasattr(Record, name)]
+            if clashes:
+                raise ValueError("Fields {} of {} clash with Record "
+                    "attributes".format(', '.join(clashes), cls.__name__))
+            record_cls = type(cls.__name__ + 'Record', (Record,), {
+                '__slots__': tuple(cls._meta.fields),
+                '_model': cls})
+            cls._record_class = record_cls
+        return record_cls
+
+
+class Record(object):
+    """
+    Compact read-only row, generated per model by `Model.record_class`
+
+    Records use `__slots__` so carry no per instance dicts, making them
+    much smaller than model instances. Columns which were not selected
+    raise AttributeError. Use `to_model()` to get a full model instance.
+    """
+    __slots__ = ()
+    _model = None
+
+    def __init__(self, **kwargs):
+        for name, value in kwargs.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Record is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("Record is read-only")
+
+    def __repr__(self):
+        return '<{}: {}>'.format(type(self).__name__, self._as_dict())
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self._as_dict() == other._as_dict()
+
+    def __hash__(self):
+        return hash((type(self), tuple(sorted(self.to_cursor_ref().items()))))
+
+    def _as_dict(self):
+        data = {}
+        for name in self.__slots__:
+            try:
+                data[name] = getattr(self, name)
+            except AttributeError:
+                pass
+        return data
+
+    def to_cursor_ref(self):
+        """Returns dict of values to uniquely reference this item"""
+        fields = self._model._meta.get_primary_keys()
+        assert fields
+        return {field.name: getattr(self, field.name) for field in fields}
+
+    def to_model(self):
+        """Returns full model instance with the same data"""
+        instance = self._model(__no_default__=1, **self._as_dict())
+        instance._dirty.clear()
+        return instance
+
+
+####################################################################
+# Mixins
+####################################################################
+
+def utcnow_no_ms():
+    """Returns utcnow without microseconds"""
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+
+class TimestampModelMixin(Model):
+    """Track creation and modification times"""
+    created = DateTimeField(default=utcnow_no_ms)
+    modified = DateTimeField()
+
+    def save(self, **kwargs):
+        self.modified = datetime.datetime.now()
+        return super(TimestampModelMixin, self).save(**kwargs)
+
+    @classmethod
+    def change_feed(cls, **kwargs):
+        """Returns `ChangeFeed` of rows by modification time"""
+        return ChangeFeed(cls, **kwargs)
+
+
+####################################################################
+# Change feed
+####################################################################
+
+class ChangeFeed(object):
+    """
+    Incrementally read rows changed since a resumable token
+
+    Rows are read in batches using keyset pagination over
+    (modified, pk), so rows sharing a timestamp are never skipped and
+    each batch is an index range scan, see `create_index`. Tokens are
+    opaque strings, store the token returned with each batch once it
+    has been processed and pass it back to resume.
+
+    Rows committed late with an older `modified` (e.g. long transactions)
+    can be missed, set `lag` to only read rows older than that many
+    seconds to allow for this.
+
+    :attr model: Model with `modified` field, e.g. `TimestampModelMixin`
+    :attr batch_size: Max rows per batch
+    :attr lag: Seconds behind now to stop reading at
+    """
+
+    def __init__(self, model, batch_size=500, lag=0, field='modified'):
+        self.model = model
+        self.batch_size = batch_size
+        self.lag = lag
+        self.field = model._meta.fields[field]
+        pk = model._meta.get_primary_keys()
+        if len(pk) != 1:
+            raise peewee.ProgrammingError(
+                'Change feed requires model with single primary key')
+        self.pk = pk[0]
+
+    def encode_token(self, row):
+        """Returns opaque token positioned after row"""
+        pk = getattr(row, self.pk.name)
+        if not isinstance(pk, (int, str)):
+            pk = str(pk)
+        value = getattr(row, self.field.name).isoformat()
+        data = json.dumps([value, pk], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+    def decode_token(self, token):
+        """Returns (modified, pk) from token"""
+        try:
+            data = base64.urlsafe_b64decode(token.encode('ascii'))
+            value, pk = json.loads(data.decode('utf-8'))
+            return (datetime.datetime.fromisoformat(value),
+                self.pk.python_value(pk))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid change feed token")
+
+    def get_query(self, token=None):
+        """Returns query for next batch after token"""
+        query = self.model.select()
+        if token is not None:
+            modified, pk = self.decode_token(token)
+            # tuple members are not converted like plain comparisons
+            position = peewee.Tuple(
+                peewee.Value(modified, converter=self.field.db_value),
+                peewee.Value(pk, converter=self.pk.db_value))
+            query = query.where(
+                peewee.Tuple(self.field, self.pk) > position)
+        if self.lag:
+            cutoff = datetime.datetime.now() - datetime.timedelta(
+                seconds=self.lag)
+            query = query.where(self.field <= cutoff)
+        return (query
+            .order_by(self.field.asc(), self.pk.asc())
+            .limit(self.batch_size))
+
+    def batches(self, token=None):
+        """
+        Yields (rows, token) for each batch of changed rows until caught
+        up, `token` resumes after the last row of the batch
+        """
+        while True:
+            rows = list(self.get_query(token))
+            if not rows:
+                return
+            token = self.encode_token(rows[-1])
+            yield rows, token
+            if len(rows) < self.batch_size:
+                return
+
+    def create_index(self):
+        """Create (modified, pk) index needed for efficient reads"""
+        index = peewee.ModelIndex(self.model, [self.field, self.pk])
+        self.model._meta.database.execute(
+            self.model._schema._create_index(index))
+
+
+####################################################################
+# Fields
+####################################################################
+
+class UUIDBlobField(peewee.BlobField):
+    """
+    Compact 16 byte UUID storage
+
+    Values are stored as BINARY(16) on MySQL and BLOB elsewhere, pass
+    `native=True` to use the native `uuid` column type on Postgres.
+    """
+
+    def __init__(self, native=False, **kwargs):
+        self.native = native
+        self._constructor = bytes
+        super(UUIDBlobField, self).__init__(**kwargs)
+
+    def ddl_datatype(self, ctx):
+        if self.native:
+            return peewee.SQL('UUID')
+        if isinstance(self.model._meta.database, peewee.MySQLDatabase):
+            return peewee.SQL('BINARY(16)')
+        return super(UUIDBlobField, self).ddl_datatype(ctx)
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(value)
+        if self.native:
+            return value.hex
+        return self._constructor(value.bytes)
+
+    def python_value(self, value):
+        if value is None or isinstance(value, uuid.UUID):
+            return value
+        if isinstance(value, str):
+            return uuid.UUID(value)
+        return uuid.UUID(bytes=bytes(value))
+
+
+class UUID7Generator(object):
+    """
+    Generates time ordered UUIDv7 values
+
+    48 bits of unix time in milliseconds are followed by a 12 bit counter
+    and 62 random bits. The counter is seeded randomly each millisecond
+    and incremented for values created within the same millisecond, so
+    values from one process are strictly increasing even if the clock
+    stalls or steps backwards. State is reset in forked children.
+    """
+
+    def __init__(self):
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._counter = 0
+
+    def __call__(self):
+        rand = int.from_bytes(os.urandom(10), 'big')
+        with self._lock:
+            ms = int(time.time() * 1000)
+            if ms > self._last_ms:
+                # seed in the lower half, leaving room to increment
+                self._counter = (rand >> 64) & 0x7ff
+            else:
+                ms = self._last_ms
+                self._counter += 1
+                if self._counter > 0xfff:
+                    # counter exhausted, borrow from the next millisecond
+                    ms += 1
+                    self._counter = 0
+            self._last_ms = ms
+            counter = self._counter
+        value = ((ms & 0xffffffffffff) << 80 | 0x7 << 76 | counter << 64 |
+            0x2 << 62 | rand & 0x3fffffffffffffff)
+        return uuid.UUID(int=value)
+
+
+uuid7 = UUID7Generator()
+
+
+class UUID7Field(UUIDBlobField):
+    """
+    Time ordered UUID field, generates UUIDv7 values client side
+
+    Unlike random v4 UUIDs, new values are always appended at the end of
+    the index, keeping B-trees compact and inserts fast. Ordering by
+    this field (e.g. `PrimaryKeyPagination`) follows creation time.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('default', uuid7)
+        super(UUID7Field, self).__init__(**kwargs)
+
+
+class OrderedUUIDField(UUIDBlobField):
+    """
+    Optimized storage for UUID fields, based on research by Percona
+    https://www.percona.com/blog/2014/12/19/store-uuid-optimized-way/
+
+    The time fields of v1 UUIDs are reordered (high, mid, low) so values
+    are stored in creation order, giving good index locality.
+
+    Conversion only slices `UUID.bytes`, no intermediate strings.
+    """
+
+    def db_value(self, value):
+        """Convert UUID to reordered binary"""
+        if value is None:
+            return None
+        if not isinstance(value, uuid.UUID):
+            value = uuid.UUID(value)
+        b = value.bytes
+        b = b[6:8] + b[4:6] + b[0:4] + b[8:]
+        if self.native:
+            return uuid.UUID(bytes=b).hex
+        return self._constructor(b)
+
+    def python_value(self, value):
+        """Convert reordered binary to UUID instance"""
+        if value is None:
+            return None
+        if isinstance(value, uuid.UUID):
+            b = value.bytes
+        elif isinstance(value, str):
+            b = uuid.UUID(value).bytes
+        else:
+            b = bytes(value)
+        return uuid.UUID(bytes=b[4:8] + b[2:4] + b[0:2] + b[8:])
+
+    def db_values(self, values):
+        """Convert list of UUIDs in bulk, see `db_value`"""
+        convert = self.db_value
+        return [convert(value) for value in values]
+
+    def python_values(self, values):
+        """
+        Convert a whole result column in bulk
+
+        Binary values skip the per value type checks of `python_value`.
+        """
+        if self.native:
+            convert = self.python_value
+            return [convert(value) for value in values]
+        UUID = uuid.UUID
+        results = []
+        append = results.append
+        for b in values:
+            if b is None:
+                append(None)
+                continue
+            if type(b) is not bytes:
+                b = bytes(b)
+            append(UUID(bytes=b[4:8] + b[2:4] + b[0:2] + b[8:]))
+        return results
+
+
+####################################################################
+# Network address fields
+####################################################################
+
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
+def pack_ip_address(address):
+    """
+    Returns 16 byte packed form of address
+
+    IPv4 addresses are mapped into IPv6 (::ffff:a.b.c.d), so both families
+    share one column and compare in numeric order.
+    """
+    if address.version == 4:
+        return IPV4_MAPPED_PREFIX + address.packed
+    return address.packed
+
+
+def unpack_ip_address(data):
+    address = ipaddress.IPv6Address(bytes(data))
+    return address.ipv4_mapped or address
+
+
+class IPAddressField(peewee.BlobField):
+    """
+    IPv4/IPv6 address field
+
+    Stored as BINARY(16) (BLOB on SQLite), or native `inet` on Postgres
+    with `native=True`. Use `in_network()` to filter by network, which
+    compiles to an indexable range predicate.
+    """
+
+    def __init__(self, native=False, **kwargs):
+        self.native = native
+        self._constructor = bytes
+        super(IPAddressField, self).__init__(**kwargs)
+
+    def ddl_datatype(self, ctx):
+        if self.native:
+            return peewee.SQL('INET')
+        if isinstance(self.model._meta.database, peewee.MySQLDatabase):
+            return peewee.SQL('BINARY(16)')
+        return super(IPAddressField, self).ddl_datatype(ctx)
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        address = ipaddress.ip_address(value)
+        if self.native:
+            return str(address)
+        return self._constructor(pack_ip_address(address))
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return ipaddress.ip_address(value)
+        return unpack_ip_address(value)
+
+    def in_network(self, network):
+        """Returns expression matching addresses within network"""
+        network = ipaddress.ip_network(network)
+        return self.between(network.network_address, network.broadcast_address)
+
+
+class IPNetworkField(peewee.BlobField):
+    """
+    IPv4/IPv6 network (CIDR) field
+
+    Stored as 17 bytes, the packed network address followed by the prefix
+    length, so networks sort by address. Native `cidr` on Postgres with
+    `native=True`. Use `within()` to filter by supernet.
+    """
+
+    def __init__(self, native=False, **kwargs):
+        self.native = native
+        self._constructor = bytes
+        super(IPNetworkField, self).__init__(**kwargs)
+
+    def ddl_datatype(self, ctx):
+        if self.native:
+            return peewee.SQL('CIDR')
+        if isinstance(self.model._meta.database, peewee.MySQLDatabase):
+            return peewee.SQL('BINARY(17)')
+        return super(IPNetworkField, self).ddl_datatype(ctx)
+
+    def _pack(self, network):
+        prefixlen = network.prefixlen
+        if network.version == 4:
+            prefixlen += 96
+        return pack_ip_address(network.network_address) + bytes((prefixlen,))
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, bytes):
+            # already packed, e.g. range bounds from `within()`
+            return self._constructor(value)
+        network = ipaddress.ip_network(value)
+        if self.native:
+            return str(network)
+        return self._constructor(self._pack(network))
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return ipaddress.ip_network(value)
+        value = bytes(value)
+        address = unpack_ip_address(value[:16])
+        prefixlen = value[16]
+        if address.version == 4:
+            prefixlen -= 96
+        return ipaddress.ip_network((address, prefixlen))
+
+    def within(self, network):
+        """Returns expression matching networks which are subnets of network"""
+        network = ipaddress.ip_network(network)
+        if self.native:
+            return peewee.Expression(self, '<<=', str(network))
+        lo = self._pack(network)
+        hi = pack_ip_address(network.broadcast_address) + b'\xff'
+        return self.between(lo, hi)
+
+
+####################################################################
+# Compression
+####################################################################
+
+class Compressor(object):
+    """
+    Compression codec for blob fields
+
+    `header` is the format byte stored in front of compressed values,
+    header 0 is reserved for uncompressed values. `stream` wraps a file
+    object of compressed data in a file object of decompressed data.
+    """
+
+    def __init__(self, name, header, compress, decompress, stream):
+        assert 0 < header < 256
+        self.name = name
+        self.header = header
+        self.compress = compress
+        self.decompress = decompress
+        self.stream = stream
+
+
+class ZlibReader(io.RawIOBase):
+    """Incrementally decompress zlib data from file object"""
+    chunk_size = 16 * 1024
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._decompressor = zlib.decompressobj()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        d = self._decompressor
+        data = b''
+        while not data and not d.eof:
+            chunk = d.unconsumed_tail or self._fileobj.read(self.chunk_size)
+            if not chunk:
+                raise EOFError("Compressed data ended before end of stream")
+            # bound output to the callers buffer
+            data = d.decompress(chunk, len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+COMPRESSORS = {}
+
+def register_compressor(compressor):
+    """Register compressor by name and header byte"""
+    assert isinstance(compressor, Compressor)
+    if compressor.header in COMPRESSORS:
+        raise RuntimeError("Compressor header already registered")
+    COMPRESSORS[compressor.name] = compressor
+    COMPRESSORS[compressor.header] = compressor
+    return compressor
+
+
+register_compressor(Compressor('zlib', 1, zlib.compress, zlib.decompress,
+    lambda fileobj: io.BufferedReader(ZlibReader(fileobj))))
+
+register_compressor(Compressor('lzma', 2, lzma.compress, lzma.decompress,
+    lzma.LZMAFile))
+
+if zstandard is not None: # pragma: nocover
+    register_compressor(Compressor('zstd', 3,
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+        lambda fileobj: zstandard.ZstdDecompressor().stream_reader(fileobj)))
+
+
+def get_compressor(name):
+    """Returns registered compressor, or `None` for no compression"""
+    if name is None:
+        return None
+    try:
+        return COMPRESSORS[name]
+    except KeyError:
+        raise ValueError("Unknown or unavailable compressor '{}'".format(name))
+
+
+def compress_value(data, compressor, threshold):
+    """Prefix data with header byte, compressing it if over threshold"""
+    if compressor is not None and len(data) >= threshold:
+        return bytes((compressor.header,)) + compressor.compress(data)
+    return b'\x00' + data
+
+
+def decompress_value(data):
+    """Reverse of `compress_value`"""
+    header = data[0]
+    if header == 0:
+        return data[1:]
+    try:
+        compressor = COMPRESSORS[header]
+    except KeyError:
+        raise ValueError("Unknown compression header '{}'".format(header))
+    return compressor.decompress(data[1:])
+
+
+def decompress_stream(data):
+    """
+    Returns file object which decompresses `compress_value` output as it
+    is read, rather than materializing the whole decompressed value
+    """
+    fileobj = io.BytesIO(data)
+    header = fileobj.read(1)[0]
+    if header == 0:
+        return fileobj
+    try:
+        compressor = COMPRESSORS[header]
+    except KeyError:
+        raise ValueError("Unknown compression header '{}'".format(header))
+    return compressor.stream(fileobj)
+
+
+####################################################################
+# JSON
+####################################################################
+
+class JSONCodec(object):
+    """Stdlib json codec, encoder and decoder are created once and reused"""
+    name = 'json'
+    is_json = True
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('separators', (',', ':'))
+        self._encoder = json.JSONEncoder(**kwargs)
+        self._decoder = json.JSONDecoder()
+
+    def encode(self, value):
+        return self._encoder.encode(value).encode('utf-8')
+
+    def decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return self._decoder.decode(data)
+
+
+class OrjsonCodec(object):
+    """orjson codec, requires `orjson`"""
+    name = 'orjson'
+    is_json = True
+
+    def __init__(self):
+        if orjson is None:
+            raise RuntimeError("orjson is not installed")
+
+    def encode(self, value):
+        return orjson.dumps(value)
+
+    def decode(self, data):
+        return orjson.loads(data)
+
+
+class MsgpackCodec(object):
+    """msgpack codec, requires `msgpack`, not compatible with native JSON"""
+    name = 'msgpack'
+    is_json = False
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed")
+
+    def encode(self, value):
+        return msgpack.packb(value, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+def get_json_codec(codec):
+    """
+    Returns codec instance from name or instance
+
+    'auto' picks orjson when installed, falling back to stdlib json.
+    """
+    if codec == 'auto':
+        codec = 'orjson' if orjson is not None else 'json'
+    if codec == 'json':
+        return JSONCodec()
+    if codec == 'orjson':
+        return OrjsonCodec()
+    if codec == 'msgpack':
+        return MsgpackCodec()
+    if isinstance(codec, str):
+        raise ValueError("Unknown codec '{}'".format(codec))
+    return codec
+
+
+class LazyValue(object):
+    """Stored value which is decoded on first attribute access"""
+    __slots__ = ('data', 'field')
+
+    def __init__(self, data, field):
+        self.data = data
+        self.field = field
+
+    def decode(self):
+        return self.field.decode(self.data)
+
+
+class LazyFieldAccessor(peewee.FieldAccessor):
+    """Decodes `LazyValue` on first access and caches the result"""
+
+    def __get__(self, instance, instance_type=None):
+        if instance is None:
+            return self.field
+        value = instance.__data__.get(self.name)
+        if type(value) is LazyValue:
+            value = instance.__data__[self.name] = value.decode()
+        return value
+
+
+class LazyCursorWrapperMixin(object):
+    """Keeps values of fields with `lazy` enabled as `LazyValue`"""
+
+    def initialize(self):
+        super(LazyCursorWrapperMixin, self).initialize()
+        for idx, field in enumerate(self.fields):
+            if (getattr(field, 'lazy', False) and
+                self.converters[idx] == field.python_value):
+                self.converters[idx] = field.lazy_value
+
+
+class LazyModelObjectCursorWrapper(LazyCursorWrapperMixin,
+    peewee.ModelObjectCursorWrapper):
+    pass
+
+
+class LazyModelCursorWrapper(LazyCursorWrapperMixin,
+    peewee.ModelCursorWrapper):
+    pass
+
+
+class LazyModelSelect(peewee.ModelSelect):
+    """
+    Select returning lazy values on model rows
+
+    Dicts, tuples etc are decoded as usual, only model instances can
+    decode on attribute access.
+    """
+
+    def _get_model_cursor_wrapper(self, cursor):
+        if len(self._from_list) == 1 and not self._joins:
+            return LazyModelObjectCursorWrapper(
+                cursor, self.model, self._returning, self.model)
+        return LazyModelCursorWrapper(cursor, self.model, self._returning,
+            self._from_list, self._joins)
+
+
+class JSONField(peewee.BlobField):
+    """
+    Store JSON in blob field
+
+    :attr codec: 'json', 'orjson', 'msgpack', 'auto' or codec instance
+    :attr compress: Compressor name, e.g. 'zlib' or 'zstd'
+    :attr compress_threshold: Min encoded size in bytes to compress
+    :attr lazy: Defer decoding of model rows until attribute access
+    :attr native: Use native JSONB column on Postgres
+
+    Blob storage starts with a header byte describing compression, see
+    `compress_value`. With `lazy` enabled, rows loaded as model instances
+    hold the raw bytes until the attribute is first read, and saving an
+    instance without reading the attribute writes the bytes back as is.
+    Code reading `__data__` directly, e.g. `model_to_dict`, then sees
+    `LazyValue`. Dict and tuple queries are always decoded.
+    """
+    accessor_class = LazyFieldAccessor
+
+    def __init__(self, codec='json', compress=None, compress_threshold=1024,
+        lazy=False, native=False, **kwargs):
+        self.codec = get_json_codec(codec)
+        self.compressor = get_compressor(compress)
+        self.compress_threshold = compress_threshold
+        self.lazy = lazy
+        self.native = native
+        if native and not self.codec.is_json:
+            raise ValueError("Native JSON requires a JSON codec")
+        if not lazy:
+            self.accessor_class = peewee.FieldAccessor
+        self._constructor = bytes
+        super(JSONField, self).__init__(**kwargs)
+
+    def ddl_datatype(self, ctx):
+        if self.native:
+            return peewee.SQL('JSONB')
+        return super(JSONField, self).ddl_datatype(ctx)
+
+    def encode(self, value):
+        """Encode python value for storage"""
+        data = self.codec.encode(value)
+        if self.native:
+            return data.decode('utf-8')
+        data = compress_value(data, self.compressor, self.compress_threshold)
+        return self._constructor(data)
+
+    def decode(self, data):
+        """Decode stored value"""
+        if self.native:
+            return self.codec.decode(data)
+        return self.codec.decode(decompress_value(data))
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if type(value) is LazyValue:
+            # never decoded, so write back stored value untouched
+            if self.native:
+                return value.data
+            return self._constructor(value.data)
+        return self.encode(value)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        if self.native and not isinstance(value, (str, bytes)):
+            # already decoded by driver, e.g. psycopg2 and jsonb
+            return value
+        if not isinstance(value, (str, bytes)):
+            value = bytes(value)
+        return self.decode(value)
+
+    def lazy_value(self, value):
+        """Returns stored value wrapped in `LazyValue`, see `lazy`"""
+        if value is None:
+            return None
+        if self.native and not isinstance(value, (str, bytes)):
+            return value
+        if not isinstance(value, (str, bytes)):
+            value = bytes(value)
+        return LazyValue(value, self)
+
+
+class CompressedBlobField(peewee.BlobField):
+    """
+    Blob field with transparent compression
+
+    :attr compress: Compressor name, 'zlib', 'lzma' or 'zstd'
+    :attr compress_threshold: Min size in bytes to compress
+    :attr lazy: Defer decompression of model rows until attribute access
+
+    Values start with a header byte naming the compressor, so changing
+    `compress` later does not break existing rows. With `lazy` enabled,
+    rows loaded as model instances are only decompressed on attribute
+    access, use `open()` to stream the value instead.
+    """
+    accessor_class = LazyFieldAccessor
+
+    def __init__(self, compress='zlib', compress_threshold=128, lazy=False,
+        **kwargs):
+        self.compressor = get_compressor(compress)
+        self.compress_threshold = compress_threshold
+        self.lazy = lazy
+        if not lazy:
+            self.accessor_class = peewee.FieldAccessor
+        self._constructor = bytes
+        super(CompressedBlobField, self).__init__(**kwargs)
+
+    def decode(self, data):
+        return decompress_value(data)
+
+    def db_value(self, value):
+        if value is None:
+            return None
+        if type(value) is LazyValue:
+            return self._constructor(value.data)
+        data = compress_value(
+            bytes(value), self.compressor, self.compress_threshold)
+        return self._constructor(data)
+
+    def python_value(self, value):
+        if value is None:
+            return None
+        return self.decode(bytes(value))
+
+    def lazy_value(self, value):
+        """Returns stored value wrapped in `LazyValue`, see `lazy`"""
+        if value is None:
+            return None
+        return LazyValue(bytes(value), self)
+
+    def open(self, instance):
+        """Returns readable file object over value of model instance"""
+        value = instance.__data__.get(self.name)
+        if value is None:
+            return None
+        if type(value) is LazyValue:
+            return decompress_stream(value.data)
+        return io.BytesIO(value)
+
+
+####################################################################
+# Field hashing
+####################################################################
+
+def ab64_encode(data):
+    """Adapted base64 used by passlib, no padding and '.' instead of '+'"""
+    return base64.b64encode(data).rstrip(b'=').replace(b'+', b'.').decode()
+
+
+def ab64_decode(data):
+    data = data.replace('.', '+')
+    return base64.b64decode(data + '=' * (-len(data) % 4))
+
+
+def pbkdf2_hash(value, rounds, salt_size):
+    """
+    Returns PBKDF2-SHA512 hash of value in passlib's `pbkdf2_sha512` format
+
+    Module level so it can be sent to a process pool.
+    """
+    salt = os.urandom(salt_size)
+    checksum = hashlib.pbkdf2_hmac('sha512', value, salt, rounds)
+    return '$pbkdf2-sha512${}${}${}'.format(
+        rounds, ab64_encode(salt), ab64_encode(checksum))
+
+
+def pbkdf2_verify(value, hashed):
+    """Returns True if value matches hash from `pbkdf2_hash`"""
+    ident, rounds, salt, checksum = parse_pbkdf2_hash(hashed)
+    expected = hashlib.pbkdf2_hmac('sha512', value, ab64_decode(salt), rounds)
+    return hmac.compare_digest(expected, ab64_decode(checksum))
+
+
+def parse_pbkdf2_hash(hashed):
+    parts = hashed.split('$')
+    if len(parts) != 5 or parts[1] != 'pbkdf2-sha512':
+        raise ValueError("Invalid pbkdf2-sha512 hash")
+    return parts[1], int(parts[2]), parts[3], parts[4]
+
+
+def coerce_to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class HashValue(str):
+    """Hash loaded from database, or created by `HashField.hash`"""
+
+    def __new__(cls, value, field):
+        obj = super(HashValue, cls).__new__(cls, value)
+        obj.field = field
+        return obj
+
+    @property
+    def rounds(self):
+        return parse_pbkdf2_hash(self)[1]
+
+    @property
+    def needs_rehash(self):
+        """True if hash was created with different rounds than the field"""
+        return self.rounds != self.field.rounds
+
+    def check(self, value):
+        """Returns True if value matches this hash"""
+        value = self.field.transform_value(value)
+        return self.field._call(pbkdf2_verify, value, str(self))
+
+    def acheck(self, value):
+        """Async version of `check`"""
+        value = self.field.transform_value(value)
+        return self.field._acall(pbkdf2_verify, value, str(self))
+
+
+class HashField(peewee.TextField):
+    """
+    Hash field, also supports encryption key
+
+    PBKDF2-SHA512 is used instead of bcrypt, see full discussion here;
+    http://security.stackexchange.com/a/6415/84745
+
+    Hashes use passlib's `pbkdf2_sha512` format but only need hashlib.
+    Hashing is slow by design, so pass `executor` (e.g. a process pool)
+    to run it outside the calling thread, and use `ahash`/`acheck` from
+    async code. Values which are already hashed are not hashed again on
+    save, so saving an unchanged instance is cheap.
+    """
+
+    def __init__(self, key=None, rounds=100000, salt_size=32, executor=None,
+        **kwargs):
+        self._key = key
+        self.rounds = rounds
+        self.salt_size = salt_size
+        self.executor = executor
+        super(HashField, self).__init__(**kwargs)
+
+    @property
+    def key(self):
+        return self._key() if callable(self._key) else self._key
+
+    @key.setter
+    def key(self, value):
+        self._key = value
+
+    def _call(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+    def _acall(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, func, *args)
+
+    def hash(self, value):
+        """Returns `HashValue` for plain text value"""
+        value = self.transform_value(value)
+        hashed = self._call(pbkdf2_hash, value, self.rounds, self.salt_size)
+        return HashValue(hashed, self)
+
+    async def ahash(self, value):
+        """Async version of `hash`"""
+        value = self.transform_value(value)
+        hashed = await self._acall(
+            pbkdf2_hash, value, self.rounds, self.salt_size)
+        return HashValue(hashed, self)
+
+    def hash_many(self, values):
+        """Returns list of `HashValue`, hashed in parallel by executor"""
+        values = [self.transform_value(value) for value in values]
+        count = len(values)
+        args = ([self.rounds] * count, [self.salt_size] * count)
+        if self.executor is None:
+            hashes = map(pbkdf2_hash, values, *args)
+        else:
+            hashes = self.executor.map(pbkdf2_hash, values, *args)
+        return [HashValue(hashed, self) for hashed in hashes]
+
+    def verify(self, instance, value):
+        """
+        Check value against the hash stored on model instance
+
+        If it matches but was hashed with different rounds, the value is
+        rehashed with the current rounds and saved.
+        """
+        hashed = getattr(instance, self.name)
+        if hashed is None:
+            return False
+        if not isinstance(hashed, HashValue):
+            hashed = HashValue(hashed, self)
+        if not hashed.check(value):
+            return False
+        if hashed.needs_rehash:
+            setattr(instance, self.name, self.hash(value))
+            instance.save(only=[self])
+        return True
+
+    def db_value(self, value):
+        """Convert the python value for storage in the database."""
+        if value is None:
+            return None
+        if isinstance(value, HashValue):
+            return str(value)
+        return str(self.hash(value))
+
+    def python_value(self, value):
+        """Convert the database value to a pythonic value."""
+        if value is None:
+            return None
+        return HashValue(value, self)
+
+    def transform_value(self, value):
+        value = coerce_to_bytes(value)
+        key = coerce_to_bytes(self.key) if self.key else None
+        return value+key if key else value
+
+
+####################################################################
+# Row readers
+####################################################################
+
+def row_converter(field):
+    """Returns function converting database value for field, or None"""
+    if not isinstance(field, peewee.Field):
+        return None
+    python_value = field.python_value
+    adapt = getattr(field.adapt, '__func__', field.adapt)
+    if (python_value.__func__ is peewee.Field.python_value and
+        adapt is peewee.Field.adapt):
+        # base implementation returns value as is, skip the call
+        return None
+    return python_value
+
+
+@functools.lru_cache(maxsize=256)
+def row_namedtuple(names):
+    return collections.namedtuple('Row', names, rename=True)
+
+
+def query_columns(query):
+    """Returns list of (name, node) for columns selected by query"""
+    columns = []
+    for node in query._returning:
+        if isinstance(node, peewee.Alias):
+            columns.append((node._alias, node.node))
+        elif isinstance(node, peewee.Field):
+            columns.append((node.name, node))
+        else:
+            columns.append(('column{}'.format(len(columns)), node))
+    return columns
+
+
+def compile_row_reader(query, row_type):
+    """
+    Returns (names, reader) for query, where reader converts a raw
+    cursor row into `row_type` ('dict', 'tuple', 'namedtuple' or
+    'record', see `Model.record_class`)
+
+    Converters are resolved once per query instead of once per row.
+    """
+    columns = query_columns(query)
+    names = tuple(name for name, node in columns)
+    converters = [row_converter(node) for name, node in columns]
+
+    indexed = [(idx, conv) for idx, conv in enumerate(converters) if conv]
+    def convert(row):
+        if not indexed:
+            return row
+        row = list(row)
+        for idx, conv in indexed:
+            value = row[idx]
+            if value is not None:
+                row[idx] = conv(value)
+        return row
+
+    if row_type == 'dict':
+        reader = lambda row: dict(zip(names, convert(row)))
+    elif row_type == 'tuple':
+        reader = lambda row: tuple(convert(row))
+    elif row_type == 'namedtuple':
+        cls = row_namedtuple(names)
+        reader = lambda row: cls._make(convert(row))
+    elif row_type == 'record':
+        cls = query.model.record_class()
+        for name in names:
+            if name not in cls.__slots__:
+                raise ValueError("Record has no field '{}'".format(name))
+        setters = [getattr(cls, name).__set__ for name in names]
+        new = object.__new__
+        def reader(row):
+            record = new(cls)
+            for setter, value in zip(setters, convert(row)):
+                setter(record, value)
+            return record
+    else:
+        raise ValueError("Unknown row type '{}'".format(row_type))
+    return names, reader
+
+
+def fetch_rows(query, row_type='dict'):
+    """
+    Execute select query and return list of lightweight rows
+
+    Rows skip model instance construction entirely, but field
+    `python_value` converters are still applied.
+    """
+    assert isinstance(query, peewee.Query)
+    names, reader = compile_row_reader(query, row_type)
+    db = query._database or query.model._meta.database
+    cursor = db.execute(query)
+    return [reader(row) for row in cursor.fetchall()]
+
+
+####################################################################
+# Columnar export
+####################################################################
+
+# stored UUID byte positions, in canonical order, see `OrderedUUIDField`
+ORDERED_UUID_INDEX = [4, 5, 6, 7, 2, 3, 0, 1] + list(range(8, 16))
+
+
+def column_kind(node):
+    """Returns how values of column are converted, see `ColumnExporter`"""
+    field = node
+    while isinstance(field, peewee.ForeignKeyField):
+        field = field.rel_field
+    if not isinstance(field, peewee.Field):
+        return 'object'
+    if isinstance(field, OrderedUUIDField):
+        # native columns hold the reordered bytes too
+        return 'ordered_uuid'
+    if isinstance(field, (peewee.UUIDField, peewee.BinaryUUIDField,
+            UUIDBlobField)):
+        return 'uuid'
+    for kind, cls in (
+            ('bool', peewee.BooleanField),
+            ('int', peewee.IntegerField),
+            ('float', peewee.FloatField),
+            ('datetime', peewee.DateTimeField),
+            ('date', peewee.DateField),
+            ('text', peewee.CharField),
+            ('text', peewee.TextField),
+            ('bytes', peewee.BlobField)):
+        if isinstance(field, cls):
+            # subclasses with their own conversion, e.g. `JSONField`
+            if type(field).python_value is not cls.python_value:
+                return 'object'
+            return kind
+    return 'object'
+
+
+def uuid_bytes(values):
+    """Returns UUID column as one buffer of 16 byte values, None as zeros"""
+    parts = []
+    append = parts.append
+    for value in values:
+        if value is None:
+            append(bytes(16))
+        elif isinstance(value, uuid.UUID):
+            append(value.bytes)
+        elif isinstance(value, str):
+            append(bytes.fromhex(value.replace('-', '')))
+        else:
+            append(value)
+    return b''.join(parts)
+
+
+class ColumnExporter(object):
+    """
+    Fetch query results in chunks straight into column arrays
+
+    Rows are never turned into model instances. Each chunk of raw cursor
+    rows is transposed into columns and converted per column: numeric,
+    date/time and UUID columns are converted by NumPy or Arrow in bulk,
+    columns of fields with custom conversion (e.g. `JSONField`) fall back
+    to per value `python_value`.
+
+    NumPy output uses masked arrays for integer, bool and UUID columns
+    with NULLs, UUIDs are 16 byte values (`V16`). Arrow output uses
+    `fixed_size_binary(16)` for UUIDs. Requires `numpy`, and `pyarrow`
+    for the Arrow methods.
+
+    :attr query: Select query
+    :attr chunk_size: Rows fetched per chunk
+    """
+
+    def __init__(self, query, chunk_size=65536):
+        assert isinstance(query, peewee.Query)
+        self.query = query
+        self.chunk_size = chunk_size
+        self.columns = [(name, column_kind(node), node)
+            for name, node in query_columns(query)]
+
+    @property
+    def names(self):
+        return [name for name, kind, node in self.columns]
+
+    def raw_chunks(self):
+        """Yields list of value tuples per column for each chunk"""
+        query = self.query
+        db = query._database or query.model._meta.database
+        cursor = db.execute(query)
+        while True:
+            rows = cursor.fetchmany(self.chunk_size)
+            if not rows:
+                return
+            yield list(zip(*rows))
+
+    def _python_values(self, node, values):
+        convert = row_converter(node)
+        if convert is None:
+            return list(values)
+        return [None if v is None else convert(v) for v in values]
+
+    def _numpy_column(self, kind, node, values):
+        if kind in ('int', 'bool'):
+            dtype = numpy.int64 if kind == 'int' else numpy.bool_
+            if None not in values:
+                return numpy.array(values, dtype=dtype)
+            mask = numpy.array([v is None for v in values])
+            data = numpy.array([0 if v is None else v for v in values],
+                dtype=dtype)
+            return numpy.ma.masked_array(data, mask=mask)
+        if kind == 'float':
+            return numpy.array(values, dtype=numpy.float64)
+        if kind == 'datetime':
+            return numpy.array(values, dtype='datetime64[us]')
+        if kind == 'date':
+            return numpy.array(values, dtype='datetime64[D]')
+        if kind in ('uuid', 'ordered_uuid'):
+            data = numpy.frombuffer(uuid_bytes(values), dtype=numpy.uint8)
+            data = data.reshape(len(values), 16)
+            if kind == 'ordered_uuid':
+                data = data[:, ORDERED_UUID_INDEX]
+            data = numpy.ascontiguousarray(data).view('V16').reshape(-1)
+            if None not in values:
+                return data
+            mask = numpy.array([v is None for v in values])
+            return numpy.ma.masked_array(data, mask=mask)
+        array = numpy.empty(len(values), dtype=object)
+        if kind == 'bytes':
+            array[:] = [None if v is None else bytes(v) for v in values]
+        else:
+            array[:] = self._python_values(node, values)
+        return array
 
+    def _arrow_column(self, kind, node, values):
+        pa = pyarrow
+        if kind == 'int':
+            return pa.array(values, pa.int64())
+        if kind == 'float':
+            return pa.array(values, pa.float64())
+        if kind == 'bool':
+            # integers on databases without a boolean type
+            return pa.array(values).cast(pa.bool_())
+        if kind in ('datetime', 'date'):
+            dtype = pa.timestamp('us') if kind == 'datetime' else pa.date32()
+            first = next((v for v in values if v is not None), None)
+            if isinstance(first, str):
+                # stored as text, e.g. SQLite
+                return pa.array(values, pa.string()).cast(dtype)
+            return pa.array(values, dtype)
+        if kind in ('uuid', 'ordered_uuid'):
+            data = uuid_bytes(values)
+            if kind == 'ordered_uuid':
+                data = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+                    len(values), 16)[:, ORDERED_UUID_INDEX].tobytes()
+            mask = None
+            if None in values:
+                mask = pa.array([v is not None for v in values]).buffers()[1]
+            return pa.FixedSizeBinaryArray.from_buffers(pa.binary(16),
+                len(values), [mask, pa.py_buffer(data)])
+        if kind == 'text':
+            return pa.array(values, pa.string())
+        if kind == 'bytes':
+            return pa.array(
+                [None if v is None else bytes(v) for v in values], pa.binary())
+        return pa.array(self._python_values(node, values))
 
-class Model(peewee.Model):
-    """Custom model"""
+    def numpy_chunks(self):
+        """Yields dict of column name to NumPy array for each chunk"""
+        if numpy is None:
+            raise RuntimeError("Columnar export requires 'numpy'")
+        for chunk in self.raw_chunks():
+            yield {name: self._numpy_column(kind, node, values)
+                for (name, kind, node), values in zip(self.columns, chunk)}
 
-    class Meta:
-        model_metadata_class = Metadata
+    def to_numpy(self):
+        """Returns dict of column name to NumPy array of all rows"""
+        chunks = list(self.numpy_chunks())
+        if not chunks:
+            return {name: numpy.empty(0, dtype=object) for name in self.names}
+        concat = lambda arrays: (numpy.ma.concatenate(arrays)
+            if any(numpy.ma.isMaskedArray(a) for a in arrays)
+            else numpy.concatenate(arrays))
+        return {name: concat([chunk[name] for chunk in chunks])
+            for name in self.names}
 
-    def update_instance(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
-        self.save()
+    def arrow_batches(self):
+        """Yields Arrow `RecordBatch` for each chunk"""
+        if pyarrow is None or numpy is None:
+            raise RuntimeError("Arrow export requires 'pyarrow' and 'numpy'")
+        for chunk in self.raw_chunks():
+            arrays = [self._arrow_column(kind, node, values)
+                for (name, kind, node), values in zip(self.columns, chunk)]
+            yield pyarrow.RecordBatch.from_arrays(arrays, names=self.names)
 
-    @classmethod
-    def create_or_get(self, **kwargs):
-        with self.atomic():
-            try:
-                return self.create(**kwargs), True
-            except peewee.IntegrityError:
-                return self.get(**kwargs), False
+    def to_arrow(self):
+        """Returns Arrow `Table` of all rows"""
+        batches = list(self.arrow_batches())
+        if not batches:
+            return pyarrow.table({name: [] for name in self.names})
+        return pyarrow.Table.from_batches(batches)
 
-    @classmethod
-    def get_or_none(cls, **kwargs):
+    def write_ipc(self, path):
         """
-        XXX: needs unit test
+        Stream all rows to Arrow IPC file, one record batch per chunk,
+        see `read_ipc`
+
+        :returns: Number of rows written
         """
+        count = 0
+        writer = None
         try:
-            return cls.get(**kwargs)
-        except cls.DoesNotExist:
-            return None
-
-    @classmethod
-    def atomic(self):
-        """Shortcut method for creating atomic context"""
-        return self._meta.database.atomic()
-    
-    def to_cursor_ref(self):
-        """Returns dict of values to uniquely reference this item"""
-        fields = self._meta.get_primary_keys()
-        assert fields
-        values = {field.name:self.__data__[field.name] for field in fields}
-        return values
-
-    @classmethod
-    def from_cursor_ref(self, cursor):
-        """Returns model instance from unique cursor reference"""
-        return self.get(**cursor)
+            for batch in self.arrow_batches():
+                if writer is None:
+                    writer = pyarrow.ipc.new_file(path, batch.schema)
+                writer.write_batch(batch)
+                count += batch.num_rows
+            if writer is None:
+                writer = pyarrow.ipc.new_file(path, self.to_arrow().schema)
+        finally:
+            if writer is not None:
+                writer.close()
+        return count
 
-    def refetch(self):
-        """
-        Return new model instance with fresh data from database
-        Only works on models which have a primary or compound key
-        See https://github.com/coleifer/peewee/issues/638
 
-        XXX: Add support for models without PK
-        """
-        ref = self.to_cursor_ref()
-        return self.from_cursor_ref(ref)
+def read_ipc(path):
+    """Returns Arrow `Table` memory mapped from IPC file, without copying"""
+    if pyarrow is None:
+        raise RuntimeError("Arrow export requires 'pyarrow'")
+    return pyarrow.ipc.open_file(pyarrow.memory_map(path, 'r')).read_all()
 
 
 ####################################################################
-# Mixins
+# Pagination
 ####################################################################
 
-def utcnow_no_ms():
-    """Returns utcnow without microseconds"""
-    return datetime.datetime.utcnow().replace(microsecond=0)
-
-
-class TimestampModelMixin(Model):
-    """Track creation and modification times"""
-    created = DateTimeField(default=utcnow_no_ms)
-    modified = DateTimeField()
+class hybridmethod(object):
+    """Method bound to the instance, or to the class when called on it"""
 
-    def save(self, **kwargs):
-        self.modified = datetime.datetime.now()
-        return super(TimestampModelMixin, self).save(**kwargs)
+    def __init__(self, func):
+        self.func = func
+        functools.update_wrapper(self, func)
 
+    def __get__(self, instance, owner):
+        return types.MethodType(
+            self.func, owner if instance is None else instance)
 
-####################################################################
-# Pagination
-####################################################################
 
 class Pagination:
     pass
@@ -198,39 +3090,46 @@ class PrimaryKeyPagination(Pagination):
     It does not support models with compound keys or no primary key
     as doing so would require using LIMIT/OFFSET which has terrible
     performance at scale. If you want this, send a PR. 
+
+    Set `guard` to a `QueryPlanGuard` to check the plan of each query,
+    on the class or on a paginator instance (e.g. `ModelCRUD.paginator`).
     """
+    guard = None
 
-    @classmethod
-    def paginate_query(self, query, count, offset=None, sort=None):
+    @hybridmethod
+    def paginate_query(self, query, count, offset=None, sort=None,
+        fields=None, exclude=None):
         """
         Apply pagination to query
 
         :attr query: Instance of `peewee.Query`
         :attr count: Max rows to return
-        :attr offset: Pagination offset, str/int
+        :attr offset: Pagination offset, str/int/UUID
         :attr sort: List of tuples, e.g. [('id', 'asc')]
+        :attr fields: List of field names to select, see `project_query`
+        :attr exclude: List of field names not to select
 
         :returns: Instance of `peewee.Query`
         """
         assert isinstance(query, peewee.Query)
         assert isinstance(count, int)
-        assert isinstance(offset, (str, int, type(None)))
+        assert isinstance(offset, (str, int, uuid.UUID, type(None)))
         assert isinstance(sort, (list, set, tuple, type(None)))
 
          # ensure our model has a primary key
-        fields = query.model._meta.get_primary_keys()
-        if len(fields) == 0:
+        pk_fields = query.model._meta.get_primary_keys()
+        if len(pk_fields) == 0:
             raise peewee.ProgrammingError(
                 'Cannot apply pagination on model without primary key')
 
         # ensure our model doesn't use a compound primary key
-        if len(fields) > 1:
+        if len(pk_fields) > 1:
             raise peewee.ProgrammingError(
                 'Cannot apply pagination on model with compound primary key')
 
         # apply offset
         if offset is not None:
-            query = query.where(fields[0] >= offset)
+            query = query.where(pk_fields[0] >= offset)
 
         # do we need to apply sorting?
         order_bys = []
@@ -250,13 +3149,403 @@ class PrimaryKeyPagination(Pagination):
                 order_bys += [order_by]
 
         # add primary key ordering after user sorting
-        order_bys += [fields[0].asc()]
+        order_bys += [pk_fields[0].asc()]
+
+        # restrict selected columns
+        if fields is not None or exclude is not None:
+            query = self.project_query(query, fields, exclude, sort)
 
         # apply ordering and limits
         query = query.order_by(*order_bys)
         query = query.limit(count)
+
+        if self.guard is not None:
+            self.guard.check(query)
         return query
 
+    @classmethod
+    def project_query(self, query, fields=None, exclude=None, sort=None):
+        """
+        Restrict query to selecting only some columns
+
+        Primary key and sort columns are always selected, so cursors can
+        still be created from the results. Selecting only indexed columns
+        lets the database answer from the index alone.
+
+        :attr query: Instance of `peewee.Query`
+        :attr fields: List of field names to select, None for all
+        :attr exclude: List of field names not to select
+        :attr sort: List of sort tuples, e.g. [('id', 'asc')]
+
+        :returns: Instance of `peewee.Query`
+        """
+        model_fields = query.model._meta.fields
+        names = list(model_fields) if fields is None else list(fields)
+        for name in itertools.chain(names, exclude or ()):
+            if name not in model_fields:
+                raise ValueError("Unknown field '{}'".format(name))
+
+        exclude = set(exclude or ())
+        names = [name for name in names if name not in exclude]
+
+        # always include primary key and sort columns
+        required = [field.name for field in query.model._meta.get_primary_keys()]
+        required += [name for name, direction in sort or ()
+            if name in model_fields]
+
+        names = unique(required + names)
+        return query.select(*[model_fields[name] for name in names])
+
+
+# names of statements prepared on each connection, see `CompiledQuery`
+_prepared_statements = weakref.WeakKeyDictionary()
+
+
+class CompiledQuery(object):
+    """
+    Paginated query compiled to SQL once, with parameter slots for the
+    offset and row count, see `PaginationCache`
+    """
+
+    def __init__(self, query, db, sql, params, offset_slots, count_slots):
+        self.query = query
+        self.db = db
+        self.sql = sql
+        self.params = params
+        self.offset_slots = offset_slots
+        self.count_slots = count_slots
+        self.pk_field = query.model._meta.get_primary_keys()[0]
+        self.statement_name = None
+        self._readers = {}
+
+    def bind_params(self, count, offset=None):
+        params = list(self.params)
+        for idx in self.count_slots:
+            params[idx] = count
+        if self.offset_slots:
+            offset = self.pk_field.db_value(offset)
+            for idx in self.offset_slots:
+                params[idx] = offset
+        return params
+
+    def execute(self, count, offset=None):
+        """Returns DB-API cursor for query"""
+        params = self.bind_params(count, offset)
+        if self.statement_name is None:
+            return self.db.execute_sql(self.sql, params)
+        return self._execute_prepared(params)
+
+    def _execute_prepared(self, params):
+        # prepared statements belong to a connection, and may have been
+        # prepared by another compiled query with the same SQL
+        conn = self.db.connection()
+        prepared = _prepared_statements.setdefault(conn, set())
+        if self.statement_name not in prepared:
+            placeholders = iter(range(1, len(params) + 1))
+            sql = re.sub('%s', lambda m: '${}'.format(next(placeholders)),
+                self.sql)
+            self.db.execute_sql('PREPARE {} AS {}'.format(
+                self.statement_name, sql))
+            prepared.add(self.statement_name)
+        args = ', '.join(['%s'] * len(params))
+        sql = 'EXECUTE {}({})'.format(self.statement_name, args) if params \
+            else 'EXECUTE {}'.format(self.statement_name)
+        return self.db.execute_sql(sql, params)
+
+    def fetch(self, count, offset=None, row_type='model'):
+        """Execute query and return list of rows, see `fetch_rows`"""
+        cursor = self.execute(count, offset)
+        if row_type == 'model':
+            return list(self.query._get_cursor_wrapper(cursor))
+        reader = self._readers.get(row_type)
+        if reader is None:
+            names, reader = compile_row_reader(self.query, row_type)
+            self._readers[row_type] = reader
+        return [reader(row) for row in cursor.fetchall()]
+
+
+class PaginationCache(object):
+    """
+    Cache of compiled SQL for paginated query shapes
+
+    Building a paginated query re-validates the sort, rebuilds the query
+    and regenerates its SQL on every call. For list endpoints the shape
+    (base query, sort, columns and whether there is an offset) repeats,
+    so the SQL is generated once per shape and only the parameters are
+    filled in afterwards.
+
+    Shapes are keyed by the SQL and parameters of the base query, pass
+    `key` to skip even that for a base query which never changes.
+
+    :attr paginator: Pagination class used to build queries
+    :attr size: Max number of shapes to cache
+    :attr prepare: Use server side prepared statements on Postgres
+    """
+
+    _OFFSET = object()
+    _COUNT = object()
+
+    def __init__(self, paginator=None, size=256, prepare=False):
+        self.paginator = paginator or PrimaryKeyPagination
+        self.size = size
+        self.prepare = prepare
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, query, db, paginator, sort, fields, exclude,
+        has_offset, key):
+        if key is None:
+            sql, params = db.get_sql_context().sql(query).query()
+            key = (sql, tuple(params))
+        freeze = lambda v: None if v is None else tuple(
+            tuple(x) if isinstance(x, (list, tuple)) else x for x in v)
+        # paginators are classes, or instances of one with their own guard
+        guard = getattr(paginator, 'guard', None)
+        if not isinstance(paginator, type):
+            paginator = type(paginator)
+        return (id(db), query.model, paginator, guard, key, freeze(sort),
+            freeze(fields), freeze(exclude), has_offset)
+
+    def compile(self, query, sort=None, fields=None, exclude=None,
+        has_offset=False, key=None, paginator=None):
+        """
+        Returns `CompiledQuery` for query shape
+
+        `paginator` overrides the pagination class of the cache.
+        """
+        db = query._database or query.model._meta.database
+        paginator = paginator or self.paginator
+        cache_key = self.get_key(
+            query, db, paginator, sort, fields, exclude, has_offset, key)
+        with self._lock:
+            compiled = self._cache.get(cache_key)
+            if compiled is not None:
+                self._cache.move_to_end(cache_key)
+                return compiled
+
+        # build query with markers where offset and count belong
+        pquery = paginator.paginate_query(query, 1, sort=sort,
+            fields=fields, exclude=exclude)
+        identity = lambda value: value
+        if has_offset:
+            pk = query.model._meta.get_primary_keys()[0]
+            pquery = pquery.where(
+                pk >= peewee.Value(self._OFFSET, converter=identity))
+        pquery = pquery.limit(peewee.Value(self._COUNT, converter=identity))
+
+        sql, params = db.get_sql_context().sql(pquery).query()
+        offset_slots = [i for i, p in enumerate(params) if p is self._OFFSET]
+        count_slots = [i for i, p in enumerate(params) if p is self._COUNT]
+        compiled = CompiledQuery(
+            pquery, db, sql, params, offset_slots, count_slots)
+        if self.prepare and isinstance(db, peewee.PostgresqlDatabase):
+            # full digest, so different SQL never shares a name
+            compiled.statement_name = 'pe_' + hashlib.sha1(
+                sql.encode('utf-8')).hexdigest()
+
+        with self._lock:
+            self._cache[cache_key] = compiled
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return compiled
+
+    def fetch(self, query, count, offset=None, sort=None, fields=None,
+        exclude=None, row_type='model', key=None, paginator=None):
+        """Returns list of rows for page, see `PrimaryKeyPagination`"""
+        compiled = self.compile(query, sort=sort, fields=fields,
+            exclude=exclude, has_offset=offset is not None, key=key,
+            paginator=paginator)
+        return compiled.fetch(count, offset, row_type)
+
+
+####################################################################
+# Partitioned scans
+####################################################################
+
+def json_key(value):
+    """Returns primary key value in JSON serializable form"""
+    if value is None or isinstance(value, (int, str)):
+        return value
+    return str(value)
+
+
+class PartitionedScan(object):
+    """
+    Walk a whole table in primary key ranges, processing them concurrently
+
+    Subclass and implement `process(rows)`, then call `run()`. The pk
+    space is split into `partitions` half-open ranges, by min/max for
+    integer keys or by quantiles otherwise, and each range is walked with
+    keyset iteration in batches of `batch_size` rows.
+
+    Ranges run in a thread pool by default, pass a `ProcessPoolExecutor`
+    to `run()` for CPU bound work; the scan and its subclass must then
+    be picklable and the models importable by the workers.
+
+    When `checkpoint` is set the ranges and the last pk of each range are
+    written to files with that path prefix after every batch, so a failed
+    run resumes where it stopped. They are removed once the scan
+    completes.
+    """
+
+    model = None
+
+    # number of pk ranges
+    partitions = 4
+
+    # rows per batch
+    batch_size = 1000
+
+    # 'minmax', 'quantiles' or 'auto' to use minmax for integer keys
+    split = 'auto'
+
+    # path prefix of checkpoint files, None to disable
+    checkpoint = None
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self._pid = os.getpid()
+
+    def get_query(self):
+        return self.model.select()
+
+    def process(self, rows):
+        raise NotImplementedError
+
+    @property
+    def pk(self):
+        return self.model._meta.primary_key
+
+    def get_ranges(self):
+        """Returns list of (lower, upper) pk ranges, None is unbounded"""
+        pk = self.pk
+        query = self.get_query().order_by()
+        split = self.split
+        if split == 'auto':
+            integer = isinstance(pk, (peewee.AutoField, peewee.IntegerField))
+            split = 'minmax' if integer else 'quantiles'
+
+        if split == 'minmax':
+            lo, hi = query.select(
+                peewee.fn.MIN(pk), peewee.fn.MAX(pk)).scalar(as_tuple=True)
+            if lo is None:
+                return [(None, None)]
+            size = hi - lo + 1
+            bounds = [lo + size * i // self.partitions
+                for i in range(1, self.partitions)]
+        elif split == 'quantiles':
+            count = query.count()
+            bounds = [query.select(pk).order_by(pk)
+                .offset(count * i // self.partitions).limit(1).scalar()
+                for i in range(1, self.partitions)]
+        else:
+            raise ValueError("Unknown split '{}'".format(split))
+
+        bounds = [b for b in unique(bounds) if b is not None]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def _checkpoint_path(self, index=None):
+        if index is None:
+            return '{}.json'.format(self.checkpoint)
+        return '{}.{}.json'.format(self.checkpoint, index)
+
+    def _write_checkpoint(self, path, data):
+        # replace atomically, a crash never leaves a partial file
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as fh:
+            json.dump(data, fh)
+        os.replace(tmp, path)
+
+    def _read_checkpoint(self, path):
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def save_progress(self, index, last, done=False):
+        """Record last pk processed in range"""
+        if self.checkpoint is not None:
+            self._write_checkpoint(self._checkpoint_path(index),
+                {'last': json_key(last), 'done': done})
+
+    def scan_range(self, index, lower, upper, last=None):
+        """Process all rows of one pk range, returns number of rows"""
+        db = self.model._meta.database
+        if os.getpid() != self._pid:
+            # forked worker, drop connection inherited from parent
+            db._state.reset()
+        opened = db.is_closed()
+        if opened:
+            db.connect()
+
+        try:
+            pk = self.pk
+            query = self.get_query()
+            if lower is not None:
+                query = query.where(pk >= lower)
+            if upper is not None:
+                query = query.where(pk < upper)
+            query = query.order_by(pk).limit(self.batch_size)
+
+            count = 0
+            while True:
+                batch = query if last is None else query.where(pk > last)
+                rows = list(batch)
+                if rows:
+                    self.process(rows)
+                    count += len(rows)
+                    last = getattr(rows[-1], pk.name)
+                if len(rows) < self.batch_size:
+                    self.save_progress(index, last, done=True)
+                    return count
+                self.save_progress(index, last)
+        finally:
+            if opened:
+                db.close()
+
+    def run(self, executor=None):
+        """
+        Scan all ranges, resuming from checkpoint if there is one
+
+        :returns: Number of rows processed
+        """
+        ranges, progress = None, {}
+        if self.checkpoint is not None:
+            ranges = self._read_checkpoint(self._checkpoint_path())
+            for index in range(len(ranges or ())):
+                state = self._read_checkpoint(self._checkpoint_path(index))
+                if state is not None:
+                    progress[index] = state
+        if ranges is None:
+            ranges = self.get_ranges()
+            if self.checkpoint is not None:
+                self._write_checkpoint(self._checkpoint_path(),
+                    [[json_key(lo), json_key(hi)] for lo, hi in ranges])
+
+        own = executor is None
+        if own:
+            executor = concurrent.futures.ThreadPoolExecutor(len(ranges))
+        try:
+            futures = []
+            for index, (lower, upper) in enumerate(ranges):
+                state = progress.get(index, {})
+                if state.get('done'):
+                    continue
+                futures.append(executor.submit(self.scan_range,
+                    index, lower, upper, state.get('last')))
+            count = sum(f.result() for f in futures)
+        finally:
+            if own:
+                executor.shutdown()
+
+        if self.checkpoint is not None:
+            for index in range(len(ranges)):
+                os.remove(self._checkpoint_path(index))
+            os.remove(self._checkpoint_path())
+        return count
+
 
 ####################################################################
 # Model List
@@ -273,6 +3562,16 @@ class ModelCRUD:
     sort_fields = []
     filter_fields = []
 
+    # columns to select, None for all
+    fields = None
+    exclude = None
+
+    # 'model' for model instances, or 'dict', 'tuple', 'namedtuple', 'record'
+    row_type = 'model'
+
+    # `PaginationCache` to reuse compiled SQL between calls
+    pagination_cache = None
+
     '''
     def get_sort_schema(self):
         """
@@ -319,9 +3618,14 @@ class ModelCRUD:
         assert isinstance(query, peewee.Query)
         assert isinstance(filters, dict)
 
-    def list(self, filters, cursor, count):
+    def list(self, filters, cursor, count, fields=None, exclude=None,
+        row_type=None):
         """
         List items from query
+
+        `fields` and `exclude` restrict the selected columns, and
+        `row_type` selects lightweight rows instead of model instances
+        (see `fetch_rows`), all defaulting to those set on the class.
         """
         assert isinstance(filters, dict), "expected filters type 'dict'"
         assert isinstance(cursor, dict), "expected cursor type 'dict'"
@@ -340,13 +3644,34 @@ class ModelCRUD:
         # always include an extra row for next cursor position
         count += 1
 
-        # apply pagination to query
-        pquery = paginator.filter_query(query, cursor, count)
-        items = [ item for item in pquery ]
+        # apply pagination to query, cursor holds the first pk to return
+        pk_fields = query.model._meta.get_primary_keys()
+        offset = cursor.get(pk_fields[0].name) if pk_fields else None
+        fields = self.fields if fields is None else fields
+        exclude = self.exclude if exclude is None else exclude
+        row_type = self.row_type if row_type is None else row_type
+        if self.pagination_cache is not None:
+            compiled = self.pagination_cache.compile(query, fields=fields,
+                exclude=exclude, has_offset=offset is not None,
+                paginator=paginator)
+            pquery = compiled.query
+            items = compiled.fetch(count, offset, row_type)
+        else:
+            pquery = paginator.paginate_query(query, count, offset=offset,
+                fields=fields, exclude=exclude)
+            if row_type == 'model':
+                items = [ item for item in pquery ]
+            else:
+                items = fetch_rows(pquery, row_type)
 
         # determine next cursor position
-        next_item = items.pop(1)
-        next_cursor = next_item.to_cursor_ref()
+        next_cursor = None
+        if len(items) == count:
+            next_item = items.pop()
+            if row_type in ('model', 'record'):
+                next_cursor = next_item.to_cursor_ref()
+            else:
+                next_cursor = self.row_cursor_ref(pquery, next_item)
 
         '''
         # is this field allowed for sort?
@@ -356,6 +3681,21 @@ class ModelCRUD:
 
         return items, next_cursor
 
+    def row_cursor_ref(self, query, row):
+        """Returns cursor reference for lightweight row, see `fetch_rows`"""
+        fields = query.model._meta.get_primary_keys()
+        if isinstance(row, dict):
+            return {field.name: row[field.name] for field in fields}
+        names = [node.name if isinstance(node, peewee.Field) else None
+            for node in query._returning]
+        return {field.name: row[names.index(field.name)] for field in fields}
+
+    async def alist(self, filters, cursor, count, fields=None, exclude=None,
+        row_type=None):
+        """Async version of `list`"""
+        return await self.get_query().model.run_async(
+            self.list, filters, cursor, count, fields, exclude, row_type)
+
     def retrieve(self, cursor):
         """
         Retrieve items from query
@@ -369,3 +3709,453 @@ class ModelCRUD:
         query
         return query.get(**cursor)
 
+
+
+####################################################################
+# Query plans
+####################################################################
+
+class QueryPlan(object):
+    """
+    EXPLAIN output for a query, with detection of expensive operations
+
+    Supports SQLite (EXPLAIN QUERY PLAN), Postgres and MySQL. Row
+    estimates are `None` where the database does not provide them.
+
+    :attr lines: Plan as list of strings
+    :attr full_scans: List of row estimates for full table scans
+    :attr filesorts: List of row estimates for sorts not served by index
+    """
+
+    PG_NODE = re.compile(
+        r'^\s*(?:->\s*)?(Seq Scan|Sort|Incremental Sort)\b.*?rows=(\d+)')
+
+    def __init__(self, db, query):
+        self.lines = []
+        self.full_scans = []
+        self.filesorts = []
+
+        sql, params = db.get_sql_context().sql(query).query()
+        if isinstance(db, peewee.SqliteDatabase):
+            self._explain_sqlite(db, sql, params)
+        elif isinstance(db, peewee.PostgresqlDatabase):
+            self._explain_postgres(db, sql, params)
+        elif isinstance(db, peewee.MySQLDatabase):
+            self._explain_mysql(db, sql, params)
+        else:
+            raise NotImplementedError(
+                "EXPLAIN not supported for '{}'".format(type(db).__name__))
+
+    def _explain_sqlite(self, db, sql, params):
+        rows = db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+        self.lines = [row[-1] for row in rows]
+        sorted_after = any(line.startswith('USE TEMP B-TREE FOR') and
+            'ORDER BY' in line for line in self.lines)
+        if sorted_after:
+            self.filesorts.append(None)
+
+        # a scan in rowid order may stop early at LIMIT, it is only a
+        # full scan when rows are filtered or sorted afterwards
+        filtered = ' WHERE ' in sql.upper()
+        for line in self.lines:
+            if line.startswith('SCAN ') and 'INDEX' not in line:
+                if filtered or sorted_after:
+                    self.full_scans.append(None)
+
+    def _explain_postgres(self, db, sql, params):
+        rows = db.execute_sql('EXPLAIN ' + sql, params).fetchall()
+        self.lines = [row[0] for row in rows]
+        for line in self.lines:
+            match = self.PG_NODE.match(line)
+            if not match:
+                continue
+            node, estimate = match.group(1), int(match.group(2))
+            if node == 'Seq Scan':
+                self.full_scans.append(estimate)
+            else:
+                self.filesorts.append(estimate)
+
+    def _explain_mysql(self, db, sql, params):
+        cursor = db.execute_sql('EXPLAIN ' + sql, params)
+        names = [col[0].lower() for col in cursor.description]
+        for row in cursor.fetchall():
+            row = dict(zip(names, row))
+            estimate = row.get('rows')
+            estimate = int(estimate) if estimate is not None else None
+            extra = row.get('extra') or ''
+            self.lines.append('table={} type={} rows={} extra={}'.format(
+                row.get('table'), row.get('type'), estimate, extra))
+            if row.get('type') == 'ALL':
+                self.full_scans.append(estimate)
+            if 'filesort' in extra:
+                self.filesorts.append(estimate)
+
+    def problems(self, max_rows=0):
+        """
+        Returns list of problems whose row estimate exceeds `max_rows`,
+        operations without an estimate are always reported
+        """
+        problems = []
+        for name, estimates in [('full scan', self.full_scans),
+            ('filesort', self.filesorts)]:
+            for estimate in estimates:
+                if estimate is None or estimate > max_rows:
+                    problems.append(name)
+                    break
+        return problems
+
+
+class QueryPlanError(peewee.ProgrammingError):
+    """Raised by `QueryPlanGuard` for queries with expensive plans"""
+
+    def __init__(self, message, problems, plan):
+        super(QueryPlanError, self).__init__(message)
+        self.problems = problems
+        self.plan = plan
+
+
+class QueryPlanGuard(object):
+    """
+    Reject (or log) queries whose plan needs a full scan or filesort
+
+    EXPLAIN runs once per distinct query shape (SQL with placeholders)
+    and database, and the verdict is cached, so the cost is only paid
+    the first time a client picks a new sort.
+
+    :attr max_rows: Allow operations estimated to touch this many rows,
+        SQLite gives no estimates so any such operation is reported
+    :attr action: 'reject' to raise `QueryPlanError`, 'log' to warn
+    :attr cache_size: Max number of query shapes to remember
+    """
+
+    def __init__(self, max_rows=1000, action='reject', cache_size=1024):
+        if action not in ('reject', 'log'):
+            raise ValueError("Invalid action '{}'".format(action))
+        self.max_rows = max_rows
+        self.action = action
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_verdict(self, query, db=None):
+        """Returns (problems, plan lines) for query, cached per shape"""
+        db = db or query._database or query.model._meta.database
+        sql, params = db.get_sql_context().sql(query).query()
+        key = (id(db), sql)
+        with self._lock:
+            verdict = self._cache.get(key)
+            if verdict is not None:
+                self._cache.move_to_end(key)
+                return verdict
+
+        plan = QueryPlan(db, query)
+        verdict = (plan.problems(self.max_rows), plan.lines)
+        with self._lock:
+            self._cache[key] = verdict
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return verdict
+
+    def check(self, query, db=None):
+        """Check query plan, raising or logging if expensive"""
+        problems, lines = self.get_verdict(query, db)
+        if not problems:
+            return
+        message = "Query plan has {}: {}".format(
+            ', '.join(problems), '; '.join(lines))
+        if self.action == 'log':
+            logger.warning(message)
+        else:
+            raise QueryPlanError(message, problems, lines)
+
+    def clear(self):
+        """Forget cached verdicts, e.g. after creating indexes"""
+        with self._lock:
+            self._cache.clear()
+
+
+####################################################################
+# Index advisor
+####################################################################
+
+IndexAdvice = collections.namedtuple('IndexAdvice',
+    ['model', 'columns', 'reason', 'exists', 'problems'])
+
+
+def index_columns(index):
+    """
+    Returns tuple of (column, direction) for `peewee.IndexMetadata`
+
+    Directions are parsed from the index SQL where available.
+    """
+    directions = []
+    if index.sql and '(' in index.sql:
+        body = index.sql[index.sql.index('(') + 1:index.sql.rindex(')')]
+        directions = [
+            'desc' if re.search(r'\bDESC\b', part, re.I) else 'asc'
+            for part in body.split(',')]
+    if len(directions) != len(index.columns):
+        directions = ['asc'] * len(index.columns)
+    return tuple(zip(index.columns, directions))
+
+
+def index_covers(index, columns):
+    """
+    Returns True if index columns start with `columns`, in the same
+    directions or all reversed (a backward index scan)
+    """
+    if len(index) < len(columns):
+        return False
+    prefix = index[:len(columns)]
+    if [name for name, d in prefix] != [name for name, d in columns]:
+        return False
+    same = [d for n, d in prefix] == [d for n, d in columns]
+    flip = {'asc': 'desc', 'desc': 'asc'}
+    reverse = [flip[d] for n, d in prefix] == [d for n, d in columns]
+    return same or reverse
+
+
+class IndexAdvisor(object):
+    """
+    Check that indexes needed by ModelCRUD listings and registered models
+    exist in the live schema
+
+    For each `ModelCRUD`, every `sort_fields` entry needs an index on the
+    sort columns followed by the primary key, matching the ordering used
+    by `PrimaryKeyPagination`. Entries may be a field name or a list of
+    (field, direction) tuples for multi column sorts. Every
+    `filter_fields` entry needs an index on the field followed by the
+    primary key. Indexes declared on models registered with the
+    `ModelManager` must exist too.
+
+    Plans are verified with EXPLAIN, see `QueryPlan`.
+    """
+
+    def __init__(self, dbm, cruds=()):
+        assert isinstance(dbm, DatabaseManager)
+        self.dbm = dbm
+        self.cruds = list(cruds)
+
+    def required_indexes(self, crud):
+        """Returns list of (model, columns, sort, reason) for crud"""
+        model = crud.get_query().model
+        pk = model._meta.get_primary_keys()
+        if len(pk) != 1:
+            return []
+        pk_column = (pk[0].column_name, 'asc')
+
+        required = []
+        for entry in crud.sort_fields:
+            if isinstance(entry, str):
+                entry = [(entry, 'asc')]
+            sort = [(name, direction.lower()) for name, direction in entry]
+            columns = [(model._meta.fields[name].column_name, direction)
+                for name, direction in sort]
+            required.append((model, tuple(columns + [pk_column]), sort,
+                'sort {}'.format(sort)))
+
+        for name in crud.filter_fields:
+            column = model._meta.fields[name].column_name
+            required.append((model, ((column, 'asc'), pk_column), None,
+                'filter {}'.format(name)))
+        return required
+
+    def declared_indexes(self, model):
+        """Returns list of column tuples for indexes declared on model"""
+        declared = []
+        for index in model._meta.fields_to_index():
+            columns = []
+            for expr in getattr(index, '_expressions', ()):
+                direction = 'asc'
+                if isinstance(expr, peewee.Ordering):
+                    direction = expr.direction.lower()
+                    expr = expr.node
+                if not isinstance(expr, peewee.Field):
+                    break
+                columns.append((expr.column_name, direction))
+            else:
+                declared.append(tuple(columns))
+        return declared
+
+    def existing_indexes(self, model):
+        """Returns list of column tuples for indexes in the live schema"""
+        db = model._meta.database
+        return [index_columns(index)
+            for index in db.get_indexes(model._meta.table_name)]
+
+    def explain(self, model, sort):
+        """Returns problems with plan of paginated query using sort"""
+        query = PrimaryKeyPagination.paginate_query(
+            model.select(), 1, sort=sort)
+        return QueryPlan(model._meta.database, query).problems()
+
+    def check(self, explain=True):
+        """Returns list of `IndexAdvice` for every required index"""
+        advice = []
+        for crud in self.cruds:
+            for model, columns, sort, reason in self.required_indexes(crud):
+                existing = self.existing_indexes(model)
+                exists = any(index_covers(i, columns) for i in existing)
+                problems = []
+                if explain and sort is not None:
+                    problems = self.explain(model, sort)
+                advice.append(IndexAdvice(model, columns, reason, exists, problems))
+
+        for model in self.dbm.models:
+            existing = self.existing_indexes(model)
+            for columns in self.declared_indexes(model):
+                exists = any(index_covers(i, columns) for i in existing)
+                advice.append(IndexAdvice(model, columns, 'declared', exists, []))
+        return advice
+
+    def missing(self):
+        """Returns `IndexAdvice` for indexes which do not exist"""
+        return [a for a in self.check(explain=False) if not a.exists]
+
+    def create_missing(self):
+        """Create missing indexes, returns list of created `IndexAdvice`"""
+        created = []
+        for advice in self.missing():
+            model = advice.model
+            # may be covered by an index created for earlier advice
+            if any(index_covers(i, advice.columns)
+                    for i in self.existing_indexes(model)):
+                continue
+            columns = [model._meta.columns[name] for name, d in advice.columns]
+            expressions = [getattr(column, direction)()
+                for column, (name, direction) in zip(columns, advice.columns)]
+            # directions are part of the name, so (name asc) and
+            # (name desc) indexes do not clash
+            name = '{}_{}'.format(model._meta.table_name, '_'.join(
+                name + ('_desc' if direction == 'desc' else '')
+                for name, direction in advice.columns))
+            index = peewee.ModelIndex(model, expressions, name=name)
+            model._meta.database.execute(model._schema._create_index(index))
+            created.append(advice)
+        return created
+
+
+####################################################################
+# Test fixtures
+####################################################################
+
+class DatabaseTemplate(object):
+    """
+    Populated database built once, then cloned cheaply for each test
+
+    `setup(db)` creates and populates the template, and only runs on the
+    first `build()`. Each `clone()` then yields a database holding the
+    same data, discarded on exit:
+
+    - sqlite: copied into a new `:memory:` database with the backup API
+    - postgres: `CREATE DATABASE ... TEMPLATE`, dropped on exit
+    - other (and `strategy='transaction'`): the template database itself
+      inside a transaction which is rolled back, so tests must not commit
+
+    For example with pytest:
+
+        template = DatabaseTemplate('sqlite:///:memory:', populate)
+
+        @pytest.fixture
+        def dbm():
+            with template.clone() as db:
+                dbm = DatabaseManager()
+                dbm.register('default', db)
+                ...
+                yield dbm
+
+    :attr db: Template database or URL
+    :attr setup: Callable populating template database
+    :attr strategy: 'auto', 'backup', 'template' or 'transaction'
+    """
+
+    # database used to create and drop postgres clones
+    maintenance_database = 'postgres'
+
+    def __init__(self, db, setup, strategy='auto'):
+        if isinstance(db, str):
+            db = playhouse.db_url.connect(db)
+        self.db = db
+        self.setup = setup
+        if strategy == 'auto':
+            if isinstance(db, peewee.SqliteDatabase):
+                strategy = 'backup'
+            elif isinstance(db, peewee.PostgresqlDatabase):
+                strategy = 'template'
+            else:
+                strategy = 'transaction'
+        if strategy not in ('backup', 'template', 'transaction'):
+            raise ValueError("Unknown strategy '{}'".format(strategy))
+        self.strategy = strategy
+        self.built = False
+        self._lock = threading.Lock()
+
+    def build(self):
+        """Create and populate template database, once"""
+        with self._lock:
+            if self.built:
+                return
+            self.db.connect(reuse_if_open=True)
+            self.setup(self.db)
+            if self.strategy == 'template':
+                # postgres refuses to copy databases with open connections
+                self.db.close()
+            self.built = True
+
+    def close(self):
+        """Close template database connection"""
+        if not self.db.is_closed():
+            self.db.close()
+
+    @contextlib.contextmanager
+    def clone(self):
+        """Yields database holding a copy of the template data"""
+        self.build()
+        clone = getattr(self, '_clone_{}'.format(self.strategy))
+        with clone() as db:
+            yield db
+
+    @contextlib.contextmanager
+    def _clone_backup(self):
+        db = type(self.db)(':memory:', pragmas=self.db._pragmas,
+            **self.db.connect_params)
+        db.connect()
+        try:
+            self.db.connection().backup(db.connection())
+            yield db
+        finally:
+            if not db.is_closed():
+                db.close()
+
+    @contextlib.contextmanager
+    def _clone_template(self):
+        maintenance = type(self.db)(self.maintenance_database,
+            **self.db.connect_params)
+        maintenance.connect()
+        # CREATE DATABASE can not run in a transaction
+        maintenance.connection().autocommit = True
+        name = '{}_clone_{}'.format(self.db.database, uuid.uuid4().hex[:12])
+        quote = lambda name: (maintenance.get_sql_context()
+            .sql(peewee.Entity(name)).query()[0])
+        try:
+            maintenance.execute_sql('CREATE DATABASE {} TEMPLATE {}'.format(
+                quote(name), quote(self.db.database)))
+            db = type(self.db)(name, **self.db.connect_params)
+            try:
+                yield db
+            finally:
+                if not db.is_closed():
+                    db.close()
+                maintenance.execute_sql(
+                    'DROP DATABASE IF EXISTS {}'.format(quote(name)))
+        finally:
+            maintenance.close()
+
+    @contextlib.contextmanager
+    def _clone_transaction(self):
+        self.db.connect(reuse_if_open=True)
+        with self.db.atomic() as txn:
+            try:
+                yield self.db
+            finally:
+                txn.rollback()
@@ -0,0 +1,123 @@
+import asyncio
+
+import peewee
+import pytest
+
+from peewee_extras import (Model, DatabaseManager, ModelCRUD,
+    PrimaryKeyPagination)
+
+####################################################################
+# Fixtures and bases
+####################################################################
+
+class AsyncModel(Model):
+    name = peewee.TextField(null=True)
+
+
+class AsyncModelCRUD(ModelCRUD):
+    paginator = PrimaryKeyPagination()
+
+    def get_query(self):
+        return AsyncModel.select()
+
+
+@pytest.fixture
+def dbm(tmpdir):
+    # connections are per worker thread, so use a file backed database
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///{}'.format(tmpdir.join('async.db')))
+    dbm.models.register(AsyncModel)
+    dbm.connect()
+    dbm.models.create_tables()
+    yield dbm
+    asyncio.run(dbm.adisconnect())
+    dbm.disconnect()
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+####################################################################
+# Async tests
+####################################################################
+
+def test_aget_or_none(dbm):
+    assert run(AsyncModel.aget_or_none(id=1)) is None
+    o1 = run(AsyncModel.acreate(id=1, name='hello'))
+    o2 = run(AsyncModel.aget_or_none(id=1))
+    assert o1 == o2
+
+
+def test_acreate_or_get(dbm):
+    o1, created = run(AsyncModel.acreate_or_get(id=1))
+    assert created is True
+    o1, created = run(AsyncModel.acreate_or_get(id=1))
+    assert created is False
+
+
+def test_asave(dbm):
+    o1 = AsyncModel(name='hello')
+    run(o1.asave())
+    assert AsyncModel.get(name='hello').id == o1.id
+
+
+def test_aconnect(dbm):
+    async def main():
+        await dbm.aconnect()
+        return await asyncio.gather(
+            *[AsyncModel.aget_or_none(id=x) for x in range(20)])
+    assert run(main()) == [None] * 20
+
+
+def test_connection_context_workers(dbm):
+    dbm.disconnect()
+
+    async def main():
+        with dbm.connection_context() as scope:
+            db = dbm.checkout('default')
+            # the worker copies our context, but not our connection
+            await dbm.run_async(db, dbm.get_database, AsyncModel)
+            return list(scope.databases)
+    assert run(main()) == [dbm['default']]
+    assert dbm['default'].is_closed()
+
+
+def test_lazy_connect(dbm):
+    dbm.disconnect()
+    dbm.lazy_connect = True
+    db = dbm['default']
+
+    async def main():
+        await AsyncModel.acreate(name='hello')
+        query = AsyncModel.select().where(AsyncModel.name == 'hello')
+        items = [item async for item in dbm.aiter(query)]
+        # only workers connected, the loop thread never blocked on it
+        assert db.is_closed()
+        return items
+    assert [item.name for item in run(main())] == ['hello']
+
+
+def test_aiter_and_alist(dbm):
+    for x in range(10):
+        AsyncModel.create(name=str(x))
+
+    async def collect():
+        query = PrimaryKeyPagination.paginate_query(AsyncModel.select(), 5)
+        return [item.name async for item in dbm.aiter(query)]
+    assert run(collect()) == ['0', '1', '2', '3', '4']
+
+    items, cursor = run(AsyncModelCRUD().alist({}, {}, 4))
+    assert [item.name for item in items] == ['0', '1', '2', '3']
+    assert cursor == {'id': 5}
+
+    items, cursor = run(AsyncModelCRUD().alist({}, cursor, 10))
+    assert len(items) == 6
+    assert cursor is None
+
+
+def test_run_async_requires_manager():
+    class Unmanaged(Model):
+        pass
+    with pytest.raises(RuntimeError):
+        Unmanaged.run_async(Unmanaged.get)
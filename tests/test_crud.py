@@ -71,23 +71,29 @@ class DatabaseManager(pe.DatabaseManager):
         assert Person.select().count() == 100
 
 
-@pytest.fixture
-def dbm():
-    # create manager
+def create_dbm(db):
     dbm = DatabaseManager()
-
-    # create db default
-    dbm.register('default', 'sqlite:///:memory:')
-    
-    # register models
+    dbm.register('default', db)
     dbm.models.register(Person)
     dbm.models.register(CompoundModel)
-
-    dbm.connect()
     dbm.models.create_tables()
-    dbm.populate_models()
-    yield dbm
-    dbm.disconnect()
+    return dbm
+
+
+def populate_template(db):
+    create_dbm(db).populate_models()
+
+
+# populated once, then cloned for each test
+template = pe.DatabaseTemplate('sqlite:///:memory:', populate_template)
+
+
+@pytest.fixture
+def dbm():
+    with template.clone() as db:
+        dbm = create_dbm(db)
+        yield dbm
+        dbm.disconnect()
 
 
 @pytest.fixture
@@ -187,3 +193,232 @@ class TestPrimaryKeyPagination:
         #print(tabulate(results, headers="keys")); assert False
 
 
+
+    def test_projection(self, dbm):
+        query = Person.select()
+
+        # pk is always selected
+        results = self.generate(query=query, count=5, fields=['name'])
+        assert [sorted(r) for r in results] == [['id', 'name']] * 5
+
+        # as are sort columns
+        sort = [('city', 'asc')]
+        results = self.generate(query=query, count=5, sort=sort,
+            exclude=['city', 'name'])
+        assert [sorted(r) for r in results] == [['city', 'id']] * 5
+
+        with pytest.raises(ValueError):
+            self.generate(query=query, count=5, fields=['unknown'])
+
+
+####################################################################
+# Test ModelCRUD
+####################################################################
+
+class PersonCRUD(pe.ModelCRUD):
+    paginator = pe.PrimaryKeyPagination()
+
+    def get_query(self):
+        return Person.select()
+
+
+class TestModelCRUD:
+
+    def test_list(self, dbm):
+        crud = PersonCRUD()
+        items, cursor = crud.list({}, {}, 40)
+        assert [item.id for item in items] == list(range(1, 41))
+        assert cursor == {'id': 41}
+
+        items, cursor = crud.list({}, {'id': 81}, 40)
+        assert len(items) == 20
+        assert cursor is None
+
+    def test_list_fields(self, dbm):
+        crud = PersonCRUD()
+        items, cursor = crud.list({}, {}, 10, fields=['city'])
+        assert sorted(items[0].__data__) == ['city', 'id']
+        assert cursor == {'id': 11}
+
+        crud.exclude = ['name']
+        items, cursor = crud.list({}, {}, 10)
+        assert sorted(items[0].__data__) == ['city', 'id']
+
+    @pytest.mark.parametrize('row_type',
+        ['dict', 'tuple', 'namedtuple', 'record'])
+    def test_list_rows(self, dbm, row_type):
+        crud = PersonCRUD()
+        models, model_cursor = crud.list({}, {}, 10)
+        items, cursor = crud.list({}, {}, 10, row_type=row_type)
+        assert cursor == model_cursor == {'id': 11}
+
+        expected = [(m.id, m.name, m.city) for m in models]
+        if row_type == 'dict':
+            items = [(r['id'], r['name'], r['city']) for r in items]
+        elif row_type in ('namedtuple', 'record'):
+            items = [(r.id, r.name, r.city) for r in items]
+        assert [tuple(r) for r in items] == expected
+
+        items, cursor = crud.list({}, {'id': 95}, 10, row_type=row_type)
+        assert len(items) == 6
+        assert cursor is None
+
+    def test_fetch_rows_converters(self, dbm):
+        from peewee_extras import JSONField
+
+        @dbm.models.register
+        class JSONModel(pe.Model):
+            value = JSONField(null=True)
+            flag = peewee.BooleanField(default=False)
+
+        dbm.models.create_tables()
+        JSONModel.create(value={'a': 1}, flag=True)
+        JSONModel.create(value=None)
+
+        query = JSONModel.select(JSONModel.value, JSONModel.flag,
+            JSONModel.id.alias('pk'))
+        rows = pe.fetch_rows(query)
+        assert rows == [{'value': {'a': 1}, 'flag': True, 'pk': 1},
+            {'value': None, 'flag': False, 'pk': 2}]
+
+    def test_records(self, dbm):
+        import sys
+
+        records = pe.fetch_rows(Person.select(), 'record')
+        record = records[0]
+        assert isinstance(record, Person.record_class())
+        assert not hasattr(record, '__dict__')
+        assert record.to_cursor_ref() == {'id': 1}
+        with pytest.raises(AttributeError):
+            record.name = 'changed'
+
+        # upgrade to model on demand
+        model = record.to_model()
+        assert isinstance(model, Person)
+        assert model == Person.get_by_id(1)
+        assert model.name == record.name
+        assert not model.is_dirty()
+
+        # unselected columns are missing rather than None
+        query = Person.select(Person.id, Person.city)
+        record = pe.fetch_rows(query, 'record')[0]
+        with pytest.raises(AttributeError):
+            record.name
+
+        # records are much smaller than model instances
+        instance = Person.get_by_id(1)
+        model_size = sum(sys.getsizeof(o) for o in
+            [instance, instance.__data__, instance.__rel__, instance._dirty])
+        assert sys.getsizeof(records[0]) * 2 < model_size
+
+    def test_record_field_names(self):
+        class Listing(pe.Model):
+            model = peewee.TextField()
+
+        record = Listing.record_class()(id=1, model='x')
+        assert record.model == 'x'
+        assert record.to_cursor_ref() == {'id': 1}
+
+        class Clashing(pe.Model):
+            to_model = peewee.TextField()
+
+        with pytest.raises(ValueError) as exc:
+            Clashing.record_class()
+        assert 'to_model' in str(exc.value)
+
+
+####################################################################
+# Test PaginationCache
+####################################################################
+
+class TestPaginationCache:
+
+    def test_fetch(self, dbm):
+        cache = pe.PaginationCache()
+        query = Person.select()
+        sort = [('city', 'asc'), ('name', 'desc')]
+
+        for offset in [None, 1, 51]:
+            expected = list(pe.PrimaryKeyPagination.paginate_query(
+                query, 20, offset=offset, sort=sort))
+            results = cache.fetch(query, 20, offset=offset, sort=sort)
+            assert results == expected
+            assert [r.name for r in results] == [r.name for r in expected]
+
+        # offset and no offset are the only two shapes
+        assert len(cache._cache) == 2
+
+        # different sort or base query params are different shapes
+        cache.fetch(query, 20, sort=[('name', 'asc')])
+        cache.fetch(query.where(Person.city == 'Seattle'), 20)
+        cache.fetch(query.where(Person.city == 'Portland'), 20)
+        assert len(cache._cache) == 5
+
+        rows = cache.fetch(query.where(Person.city == 'Portland'), 5,
+            fields=['name'], row_type='dict')
+        assert [sorted(r) for r in rows] == [['id', 'name']] * 5
+
+    def test_crud(self, dbm):
+        crud = PersonCRUD()
+        crud.pagination_cache = pe.PaginationCache()
+        for row_type in ['model', 'dict']:
+            items, cursor = crud.list({}, {}, 40, row_type=row_type)
+            assert cursor == {'id': 41}
+            items, cursor = crud.list({}, cursor, 40, row_type=row_type)
+            assert cursor == {'id': 81}
+        assert len(crud.pagination_cache._cache) == 2
+
+    def test_crud_paginator(self, dbm):
+        calls = []
+        class GuardedPagination(pe.PrimaryKeyPagination):
+            @classmethod
+            def paginate_query(cls, query, count, **kwargs):
+                calls.append(count)
+                return super().paginate_query(
+                    query.where(Person.city == 'Seattle'), count, **kwargs)
+
+        crud = PersonCRUD()
+        crud.paginator = GuardedPagination()
+        crud.pagination_cache = pe.PaginationCache()
+        items, cursor = crud.list({}, {}, 10)
+        assert calls
+        assert {item.city for item in items} == {'Seattle'}
+
+    def test_statement_name(self, dbm):
+        cache = pe.PaginationCache(prepare=True)
+        db = peewee.PostgresqlDatabase(None)
+        names = set()
+        for city in ['Seattle', 'Portland']:
+            query = Person.select().where(Person.city == city)
+            compiled = cache.compile(query.bind(db))
+            names.add(compiled.statement_name)
+        # different shapes with the same SQL share the statement
+        assert len(cache._cache) == 2
+        assert len(names) == 1
+        compiled = cache.compile(Person.select().bind(db))
+        assert compiled.statement_name not in names
+
+
+####################################################################
+# Test database template
+####################################################################
+
+class TestDatabaseTemplate:
+
+    def test_clone(self, dbm):
+        Person.delete().execute()
+        with template.clone() as db:
+            other = create_dbm(db)
+            assert Person.select().count() == 100
+            other.disconnect()
+
+    def test_transaction(self, tmpdir):
+        db = peewee.SqliteDatabase(str(tmpdir.join('template.db')))
+        t = pe.DatabaseTemplate(db, populate_template, strategy='transaction')
+        for x in range(2):
+            with t.clone() as db:
+                create_dbm(db)
+                assert Person.select().count() == 100
+                Person.delete().execute()
+                assert Person.select().count() == 0
+        t.close()
@@ -0,0 +1,148 @@
+import datetime
+import uuid
+
+import peewee
+import pytest
+
+numpy = pytest.importorskip('numpy')
+pyarrow = pytest.importorskip('pyarrow')
+
+from peewee_extras import (Model, DatabaseManager, ColumnExporter,
+    OrderedUUIDField, JSONField, read_ipc, fetch_rows, column_kind,
+    uuid_bytes, ORDERED_UUID_INDEX)
+
+####################################################################
+# Fixtures and bases
+####################################################################
+
+class ExportParent(Model):
+    name = peewee.TextField()
+
+
+class ExportModel(Model):
+    parent = peewee.ForeignKeyField(ExportParent, null=True)
+    count = peewee.IntegerField(null=True)
+    ratio = peewee.FloatField(null=True)
+    flag = peewee.BooleanField()
+    created = peewee.DateTimeField()
+    day = peewee.DateField()
+    name = peewee.TextField()
+    data = peewee.BlobField()
+    uid = peewee.UUIDField(null=True)
+    ordered = OrderedUUIDField()
+    extra = JSONField(null=True)
+
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///:memory:')
+    dbm.models.register(ExportParent)
+    dbm.models.register(ExportModel)
+    dbm.connect()
+    dbm.models.create_tables()
+    yield dbm
+    dbm.disconnect()
+    ExportParent._meta.database = ExportModel._meta.database = None
+
+
+def populate(count):
+    parent = ExportParent.create(name='parent')
+    start = datetime.datetime(2020, 1, 1, 12, 30)
+    rows = [{
+        'parent': parent if x % 2 else None,
+        'count': None if x == 3 else x,
+        'ratio': x / 2,
+        'flag': bool(x % 3),
+        'created': start + datetime.timedelta(seconds=x, microseconds=x),
+        'day': start.date() + datetime.timedelta(days=x),
+        'name': 'name{}'.format(x),
+        'data': bytes([x % 256]) * 3,
+        'uid': None if x == 4 else uuid.uuid4(),
+        'ordered': uuid.uuid1(),
+        'extra': {'x': x},
+    } for x in range(count)]
+    with ExportModel._meta.database.atomic():
+        for batch in peewee.chunked(rows, 50):
+            ExportModel.insert_many(batch).execute()
+
+
+####################################################################
+# Columnar export tests
+####################################################################
+
+def test_numpy(dbm):
+    populate(10)
+    query = ExportModel.select().order_by(ExportModel.id)
+    expected = fetch_rows(query)
+    columns = ColumnExporter(query, chunk_size=3).to_numpy()
+
+    assert columns['id'].dtype == numpy.int64
+    assert columns['count'].mask.tolist() == [x == 3 for x in range(10)]
+    assert columns['count'][5] == 5
+    assert columns['flag'].dtype == numpy.bool_
+    assert columns['created'].dtype == numpy.dtype('datetime64[us]')
+    assert columns['created'][7].item() == expected[7]['created']
+    assert columns['day'][7].item() == expected[7]['day']
+    assert columns['data'][2] == b'\x02\x02\x02'
+    assert columns['extra'][6] == {'x': 6}
+    assert columns['parent'].mask.tolist() == [x % 2 == 0 for x in range(10)]
+    assert columns['uid'].mask[4]
+    for x in range(10):
+        assert columns['ordered'][x].tobytes() == expected[x]['ordered'].bytes
+        if x != 4:
+            assert columns['uid'][x].tobytes() == expected[x]['uid'].bytes
+
+
+def test_arrow(dbm, tmpdir):
+    populate(10)
+    query = ExportModel.select().order_by(ExportModel.id)
+    expected = fetch_rows(query)
+    exporter = ColumnExporter(query, chunk_size=4)
+    table = exporter.to_arrow()
+
+    assert table.num_rows == 10
+    assert table.schema.field('created').type == pyarrow.timestamp('us')
+    assert table.schema.field('ordered').type == pyarrow.binary(16)
+    rows = table.to_pylist()
+    for row, exp in zip(rows, expected):
+        assert row['created'] == exp['created']
+        assert row['day'] == exp['day']
+        assert row['count'] == exp['count']
+        assert row['parent'] == exp['parent']
+        assert row['ordered'] == exp['ordered'].bytes
+        assert row['uid'] == (exp['uid'] and exp['uid'].bytes)
+
+    path = str(tmpdir.join('export.arrow'))
+    assert exporter.write_ipc(path) == 10
+    mapped = read_ipc(path)
+    assert mapped.equals(table)
+
+
+def test_empty(dbm, tmpdir):
+    query = ExportModel.select(ExportModel.id, ExportModel.name)
+    assert ColumnExporter(query).to_numpy()['id'].size == 0
+    assert ColumnExporter(query).to_arrow().num_rows == 0
+
+
+def test_native_ordered_uuid():
+    field = OrderedUUIDField(native=True)
+    assert column_kind(field) == 'ordered_uuid'
+    value = uuid.uuid1()
+    data = numpy.frombuffer(uuid_bytes([field.db_value(value)]),
+        dtype=numpy.uint8)[ORDERED_UUID_INDEX]
+    assert data.tobytes() == value.bytes
+
+
+def test_benchmark_export(dbm, benchmark):
+    populate(5000)
+    query = ExportModel.select(ExportModel.id, ExportModel.ratio,
+        ExportModel.created, ExportModel.ordered)
+    benchmark(lambda: ColumnExporter(query).to_numpy())
+
+
+def test_benchmark_models(dbm, benchmark):
+    populate(5000)
+    query = ExportModel.select(ExportModel.id, ExportModel.ratio,
+        ExportModel.created, ExportModel.ordered)
+    benchmark(lambda: list(query.clone()))
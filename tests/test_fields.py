@@ -0,0 +1,437 @@
+import binascii
+import json
+import uuid
+
+import peewee
+import pytest
+
+from peewee_extras import (Model, DatabaseManager, OrderedUUIDField,
+    UUID7Field, UUIDBlobField, PrimaryKeyPagination, uuid7)
+
+####################################################################
+# Fixtures and bases
+####################################################################
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///:memory:')
+    dbm.connect()
+    yield dbm
+    dbm.disconnect()
+
+
+def create_model(dbm, **fields):
+    model = type('FieldModel', (Model,), dict(fields))
+    dbm.models.register(model)
+    dbm.models.create_tables()
+    return model
+
+
+####################################################################
+# OrderedUUIDField
+####################################################################
+
+def legacy_db_value(value):
+    """Original string based conversion, kept for comparison"""
+    parts = str(value).split("-")
+    reordered = ''.join([parts[2], parts[1], parts[0], parts[3], parts[4]])
+    return binascii.unhexlify(reordered)
+
+
+class TestOrderedUUIDField:
+
+    def test_field(self):
+        f = OrderedUUIDField()
+        for x in range(10):
+            value = uuid.uuid1()
+            as_binary = f.db_value(value)
+            assert as_binary == legacy_db_value(value)
+            assert f.python_value(as_binary) == value
+            assert f.python_value(memoryview(as_binary)) == value
+            assert f.db_value(str(value)) == as_binary
+        assert f.db_value(None) is None
+        assert f.python_value(None) is None
+
+    def test_native(self):
+        f = OrderedUUIDField(native=True)
+        value = uuid.uuid1()
+        as_native = f.db_value(value)
+        assert uuid.UUID(as_native).bytes == legacy_db_value(value)
+        assert f.python_value(as_native) == value
+        assert f.python_value(uuid.UUID(as_native)) == value
+
+    def test_bulk(self):
+        f = OrderedUUIDField()
+        values = [uuid.uuid1() for x in range(10)] + [None]
+        stored = [None if v is None else f.db_value(v) for v in values]
+        assert f.python_values(stored) == values
+        assert f.python_values([memoryview(stored[0])]) == values[:1]
+
+    def test_with_model(self, dbm):
+        FieldModel = create_model(dbm, value=OrderedUUIDField())
+        ids = [uuid.uuid1() for x in range(10)]
+        for value in ids:
+            FieldModel.create(value=value)
+        assert [o.value for o in FieldModel.select()] == ids
+
+        # stored order follows creation time
+        query = FieldModel.select().order_by(FieldModel.value)
+        assert [o.value for o in query] == ids
+
+    def test_ddl(self):
+        f = OrderedUUIDField(native=True)
+        assert f.ddl_datatype(None).sql == 'UUID'
+
+        class MySQLDatabase(peewee.MySQLDatabase):
+            # avoid requiring the mysql driver
+            def get_binary_type(self):
+                return bytes
+
+        class MySQLModel(Model):
+            value = OrderedUUIDField()
+            class Meta:
+                database = MySQLDatabase(None)
+        ddl = MySQLModel._meta.fields['value'].ddl_datatype(None)
+        assert ddl.sql == 'BINARY(16)'
+
+    def test_benchmark_db_value(self, benchmark):
+        f = OrderedUUIDField()
+        values = [uuid.uuid1() for x in range(1000)]
+        benchmark(f.db_values, values)
+
+    def test_benchmark_python_value(self, benchmark):
+        f = OrderedUUIDField()
+        values = [f.db_value(uuid.uuid1()) for x in range(1000)]
+        benchmark(f.python_values, values)
+
+
+####################################################################
+# UUID7Field
+####################################################################
+
+class TestUUID7Field:
+
+    def test_uuid7(self):
+        values = [uuid7() for x in range(5000)]
+        assert values == sorted(values)
+        assert len(set(values)) == len(values)
+        assert all(v.version == 7 for v in values)
+        assert all(v.variant == uuid.RFC_4122 for v in values)
+
+    def test_uuid7_threads(self):
+        import threading
+        results = []
+        def worker():
+            results.extend(uuid7() for x in range(1000))
+        threads = [threading.Thread(target=worker) for x in range(4)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        assert len(set(results)) == 4000
+
+    def test_with_pagination(self, dbm):
+        FieldModel = create_model(dbm,
+            id=UUID7Field(primary_key=True), name=peewee.TextField())
+        for x in range(10):
+            FieldModel.create(name=str(x))
+
+        first = PrimaryKeyPagination.paginate_query(FieldModel.select(), 5)
+        assert [o.name for o in first] == ['0', '1', '2', '3', '4']
+
+        offset = list(first)[-1].id
+        query = PrimaryKeyPagination.paginate_query(
+            FieldModel.select(), 3, offset=offset)
+        assert [o.name for o in query] == ['4', '5', '6']
+
+    @pytest.mark.parametrize('default', [uuid7, uuid.uuid4],
+        ids=['uuid7', 'uuid4'])
+    def test_benchmark_insert(self, dbm, benchmark, default):
+        FieldModel = create_model(dbm,
+            id=UUIDBlobField(primary_key=True, default=default))
+        def insert():
+            with dbm['default'].atomic():
+                for x in range(1000):
+                    FieldModel.create()
+        benchmark.pedantic(insert, rounds=5)
+
+
+####################################################################
+# JSONField
+####################################################################
+
+from playhouse.shortcuts import model_to_dict
+
+from peewee_extras import JSONField, LazyValue
+
+
+class TestJSONField:
+    data = {'name': 'hello', 'items': [1, 2, 3], 'nested': {'a': None}}
+
+    @pytest.mark.parametrize('codec', ['json', 'orjson', 'msgpack'])
+    def test_codecs(self, codec):
+        if codec != 'json':
+            pytest.importorskip(codec)
+        f = JSONField(codec=codec, lazy=False)
+        assert f.python_value(f.db_value(self.data)) == self.data
+        assert f.python_value(f.db_value({})) == {}
+        assert f.db_value(None) is None
+
+    def test_compression(self):
+        f = JSONField(compress='zlib', compress_threshold=100, lazy=False)
+        small = f.db_value({'a': 1})
+        assert small[0] == 0
+        assert f.python_value(small) == {'a': 1}
+
+        value = {'items': ['x' * 10] * 100}
+        large = f.db_value(value)
+        assert large[0] == 1
+        assert len(large) < 100
+        assert f.python_value(large) == value
+
+        # readers without compression enabled still decode
+        assert JSONField(lazy=False).python_value(large) == value
+
+        with pytest.raises(ValueError):
+            JSONField(compress='unknown')
+
+    def test_native(self):
+        f = JSONField(native=True, lazy=False)
+        assert f.ddl_datatype(None).sql == 'JSONB'
+        assert f.db_value(self.data) == json.dumps(
+            self.data, separators=(',', ':'))
+        assert f.python_value(f.db_value(self.data)) == self.data
+        assert f.python_value(self.data) is self.data
+        class BinaryCodec(object):
+            is_json = False
+        with pytest.raises(ValueError):
+            JSONField(native=True, codec=BinaryCodec())
+
+    def test_queries(self, dbm):
+        FieldModel = create_model(dbm, value=JSONField())
+        o = FieldModel.create(value=self.data)
+
+        o = FieldModel.get_by_id(o.id)
+        assert o.__data__['value'] == self.data
+        assert model_to_dict(o)['value'] == self.data
+        assert FieldModel.select(FieldModel.value).dicts().get() == {
+            'value': self.data}
+        assert FieldModel.select(FieldModel.value).tuples().get() == (
+            self.data,)
+
+    def test_lazy(self, dbm):
+        FieldModel = create_model(dbm,
+            value=JSONField(lazy=True), other=JSONField(lazy=True))
+        o = FieldModel.create(value=self.data, other=[1])
+
+        # only model rows are lazy
+        query = FieldModel.select(FieldModel.value)
+        assert query.dicts().get() == {'value': self.data}
+        assert query.tuples().get() == (self.data,)
+
+        o = FieldModel.get_by_id(o.id)
+        assert type(o.__data__['value']) is LazyValue
+        assert o.value == self.data
+        assert o.__data__['value'] == self.data
+
+        # undecoded values are written back untouched
+        stored = o.__data__['other'].data
+        o.save()
+        o = FieldModel.get_by_id(o.id)
+        assert o.__data__['other'].data == stored
+        assert o.other == [1]
+
+
+####################################################################
+# HashField
+####################################################################
+
+import asyncio
+import concurrent.futures
+
+from peewee_extras import HashField, HashValue
+
+
+class TestHashField:
+
+    def test_field(self):
+        f = HashField(rounds=1000, key='pepper')
+        hashed = f.python_value(f.db_value('secret'))
+        assert isinstance(hashed, HashValue)
+        assert hashed.startswith('$pbkdf2-sha512$1000$')
+        assert hashed.check('secret')
+        assert not hashed.check('wrong')
+        assert not HashField(rounds=1000).python_value(hashed).check('secret')
+
+    def test_passlib_compatible(self):
+        passlib = pytest.importorskip('passlib.hash')
+        f = HashField(rounds=1000)
+        hashed = f.hash('secret')
+        assert passlib.pbkdf2_sha512.verify('secret', hashed)
+        other = passlib.pbkdf2_sha512.using(rounds=1000).hash('secret')
+        assert f.python_value(other).check('secret')
+
+    def test_executor(self):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=2) as pool:
+            f = HashField(rounds=1000, executor=pool)
+            hashes = f.hash_many(['a', 'b', 'c'])
+            assert [h.check(v) for h, v in zip(hashes, 'abc')] == [True] * 3
+            assert len(set(hashes)) == 3
+
+            async def main():
+                hashed = await f.ahash('secret')
+                return await hashed.acheck('secret')
+            assert asyncio.run(main()) is True
+
+    def test_with_model(self, dbm):
+        FieldModel = create_model(dbm, password=HashField(rounds=1000))
+        o = FieldModel.create(password='secret')
+        o = FieldModel.get_by_id(o.id)
+        stored = o.password
+        assert o.password.check('secret')
+
+        # saving unchanged instance does not rehash
+        o.save()
+        assert FieldModel.get_by_id(o.id).password == stored
+
+    def test_rehash_on_verify(self, dbm):
+        FieldModel = create_model(dbm, password=HashField(rounds=1000))
+        field = FieldModel.password
+        o = FieldModel.create(password='secret')
+
+        field.rounds = 2000
+        o = FieldModel.get_by_id(o.id)
+        assert o.password.needs_rehash
+        assert not field.verify(o, 'wrong')
+        assert field.verify(o, 'secret')
+
+        o = FieldModel.get_by_id(o.id)
+        assert o.password.rounds == 2000
+        assert not o.password.needs_rehash
+        assert field.verify(o, 'secret')
+
+
+####################################################################
+# CompressedBlobField
+####################################################################
+
+from peewee_extras import CompressedBlobField, decompress_stream
+
+
+class TestCompressedBlobField:
+    data = b''.join(str(x).encode() for x in range(20000))
+
+    @pytest.mark.parametrize('compress', ['zlib', 'lzma', 'zstd'])
+    def test_field(self, compress):
+        if compress == 'zstd':
+            pytest.importorskip('zstandard')
+        f = CompressedBlobField(compress=compress)
+        stored = f.db_value(self.data)
+        assert len(stored) < len(self.data) / 2
+        assert f.python_value(stored) == self.data
+
+        # read stream in small pieces
+        stream = decompress_stream(stored)
+        assert stream.read(10) == self.data[:10]
+        assert stream.read() == self.data[10:]
+
+    def test_threshold(self):
+        f = CompressedBlobField(compress_threshold=100)
+        stored = f.db_value(b'small')
+        assert stored == b'\x00small'
+        assert decompress_stream(stored).read() == b'small'
+
+    def test_with_model(self, dbm):
+        FieldModel = create_model(dbm, value=CompressedBlobField())
+        o = FieldModel.create(value=self.data)
+        assert FieldModel.value.open(o).read() == self.data
+
+        o = FieldModel.get_by_id(o.id)
+        with FieldModel.value.open(o) as fh:
+            assert fh.read(5) == self.data[:5]
+        assert o.value == self.data
+        assert model_to_dict(o)['value'] == self.data
+        assert FieldModel.select(FieldModel.value).tuples().get() == (
+            self.data,)
+
+    def test_lazy(self, dbm):
+        FieldModel = create_model(dbm, value=CompressedBlobField(lazy=True))
+        o = FieldModel.create(value=self.data)
+        assert FieldModel.select(FieldModel.value).dicts().get() == {
+            'value': self.data}
+
+        o = FieldModel.get_by_id(o.id)
+        assert type(o.__data__['value']) is LazyValue
+        with FieldModel.value.open(o) as fh:
+            assert fh.read(5) == self.data[:5]
+        assert o.value == self.data
+
+
+####################################################################
+# Network address fields
+####################################################################
+
+import ipaddress
+
+from peewee_extras import IPAddressField, IPNetworkField
+
+
+class TestIPAddressField:
+
+    def test_field(self):
+        f = IPAddressField()
+        for value in ['127.0.0.1', '::1', '2001:db8::ff00:42:8329']:
+            stored = f.db_value(value)
+            assert len(stored) == 16
+            assert f.python_value(stored) == ipaddress.ip_address(value)
+        assert f.db_value('127.0.0.1')[-4:] == b'\x7f\x00\x00\x01'
+
+        f = IPAddressField(native=True)
+        assert f.ddl_datatype(None).sql == 'INET'
+        assert f.db_value('::1') == '::1'
+        assert f.python_value('10.0.0.1') == ipaddress.ip_address('10.0.0.1')
+
+    def test_in_network(self, dbm):
+        FieldModel = create_model(dbm, value=IPAddressField(index=True))
+        for value in ['10.0.0.1', '10.0.0.255', '10.0.1.0', '9.255.255.255',
+            '::ffff:10.0.0.9', '2001:db8::1', '2001:db9::1']:
+            FieldModel.create(value=value)
+
+        def lookup(network):
+            query = FieldModel.select().where(
+                FieldModel.value.in_network(network))
+            return sorted(str(o.value) for o in query)
+
+        assert lookup('10.0.0.0/24') == ['10.0.0.1', '10.0.0.255', '10.0.0.9']
+        assert lookup('2001:db8::/32') == ['2001:db8::1']
+
+        sql, params = FieldModel.select().where(
+            FieldModel.value.in_network('10.0.0.0/24')).sql()
+        assert 'BETWEEN' in sql
+
+
+class TestIPNetworkField:
+
+    def test_field(self):
+        f = IPNetworkField()
+        for value in ['10.0.0.0/8', '10.1.0.0/16', '2001:db8::/32', '::/0']:
+            stored = f.db_value(value)
+            assert len(stored) == 17
+            assert f.python_value(stored) == ipaddress.ip_network(value)
+
+        f = IPNetworkField(native=True)
+        assert f.ddl_datatype(None).sql == 'CIDR'
+        assert f.db_value('10.0.0.0/8') == '10.0.0.0/8'
+
+    def test_within(self, dbm):
+        FieldModel = create_model(dbm, value=IPNetworkField(index=True))
+        for value in ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24', '11.0.0.0/8',
+            '2001:db8::/32']:
+            FieldModel.create(value=value)
+
+        def lookup(network):
+            query = FieldModel.select().where(FieldModel.value.within(network))
+            return sorted(str(o.value) for o in query)
+
+        assert lookup('10.0.0.0/8') == ['10.0.0.0/8', '10.1.0.0/16', '10.1.2.0/24']
+        assert lookup('10.1.0.0/16') == ['10.1.0.0/16', '10.1.2.0/24']
+        assert lookup('2001::/16') == ['2001:db8::/32']
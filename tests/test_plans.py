@@ -0,0 +1,167 @@
+import peewee
+import pytest
+
+from peewee_extras import (Model, DatabaseManager, ModelCRUD,
+    PrimaryKeyPagination, QueryPlan, IndexAdvisor)
+
+####################################################################
+# Fixtures and bases
+####################################################################
+
+class PlanModel(Model):
+    name = peewee.TextField()
+    city = peewee.TextField()
+    age = peewee.IntegerField(index=True)
+
+    class Meta:
+        indexes = ((('city', 'name'), False),)
+
+
+class PlanModelCRUD(ModelCRUD):
+    sort_fields = ['name', [('city', 'asc'), ('name', 'desc')]]
+    filter_fields = ['age']
+
+    def get_query(self):
+        return PlanModel.select()
+
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///:memory:')
+    dbm.models.register(PlanModel)
+    dbm.connect()
+    dbm.models.create_tables()
+    yield dbm
+    dbm.disconnect()
+    PlanModel._meta.database = None
+
+
+def paginate(sort=None):
+    return PrimaryKeyPagination.paginate_query(
+        PlanModel.select(), 10, sort=sort)
+
+
+####################################################################
+# Query plan tests
+####################################################################
+
+def test_query_plan(dbm):
+    db = dbm['default']
+    plan = QueryPlan(db, paginate())
+    assert plan.problems() == []
+
+    plan = QueryPlan(db, paginate(sort=[('name', 'asc')]))
+    assert plan.problems() == ['full scan', 'filesort']
+
+    plan = QueryPlan(db, paginate(sort=[('city', 'asc'), ('name', 'asc')]))
+    assert plan.problems() == []
+
+    plan = QueryPlan(db, PlanModel.select().where(PlanModel.name == 'x'))
+    assert plan.problems() == ['full scan']
+
+
+####################################################################
+# Index advisor tests
+####################################################################
+
+def test_index_advisor(dbm):
+    advisor = IndexAdvisor(dbm, [PlanModelCRUD()])
+    advice = {(a.columns, a.reason): a for a in advisor.check()}
+
+    name = advice[((('name', 'asc'), ('id', 'asc')), "sort [('name', 'asc')]")]
+    assert not name.exists
+    assert name.problems == ['full scan', 'filesort']
+
+    # declared indexes exist, but not with the pk and directions we need
+    combo = [a for a in advice.values() if a.reason.startswith("sort [('city'")]
+    assert not combo[0].exists
+    assert all(a.exists for a in advice.values() if a.reason == 'declared')
+
+    created = advisor.create_missing()
+    assert len(created) == 3
+    assert advisor.missing() == []
+    assert all(a.problems == [] for a in advisor.check())
+    assert advisor.create_missing() == []
+
+
+def test_index_advisor_directions(dbm):
+    class DirectionCRUD(PlanModelCRUD):
+        sort_fields = ['name', [('name', 'desc')], [('name', 'desc')]]
+        filter_fields = []
+
+    advisor = IndexAdvisor(dbm, [DirectionCRUD()])
+    created = advisor.create_missing()
+    assert [a.columns for a in created] == [
+        (('name', 'asc'), ('id', 'asc')), (('name', 'desc'), ('id', 'asc'))]
+    assert advisor.missing() == []
+    names = [i.name for i in dbm['default'].get_indexes('planmodel')]
+    assert 'planmodel_name_desc_id' in names
+
+
+def test_index_advisor_missing_declared(dbm):
+    db = dbm['default']
+    db.execute_sql('DROP INDEX planmodel_age')
+    advisor = IndexAdvisor(dbm)
+    missing = advisor.missing()
+    assert [(a.columns, a.reason) for a in missing] == [
+        ((('age', 'asc'),), 'declared')]
+    advisor.create_missing()
+    assert advisor.missing() == []
+
+
+####################################################################
+# Query plan guard tests
+####################################################################
+
+from peewee_extras import QueryPlanGuard, QueryPlanError, PaginationCache
+
+
+class GuardedPagination(PrimaryKeyPagination):
+    guard = QueryPlanGuard()
+
+
+def test_query_plan_guard(dbm):
+    GuardedPagination.guard.clear()
+    query = GuardedPagination.paginate_query(PlanModel.select(), 10)
+    assert list(query) == []
+
+    with pytest.raises(QueryPlanError) as exc:
+        GuardedPagination.paginate_query(
+            PlanModel.select(), 10, sort=[('name', 'desc')])
+    assert exc.value.problems == ['full scan', 'filesort']
+
+    # verdict is cached per query shape
+    assert len(GuardedPagination.guard._cache) == 2
+    GuardedPagination.paginate_query(PlanModel.select(), 20)
+    assert len(GuardedPagination.guard._cache) == 2
+
+
+def test_query_plan_guard_crud(dbm):
+    class UnindexedCRUD(PlanModelCRUD):
+        def get_query(self):
+            return PlanModel.select().where(PlanModel.name == 'x')
+
+    # guard set on the paginator instance applies
+    crud = UnindexedCRUD()
+    crud.paginator = PrimaryKeyPagination()
+    assert crud.list({}, {}, 10) == ([], None)
+    crud.paginator.guard = QueryPlanGuard()
+    with pytest.raises(QueryPlanError):
+        crud.list({}, {}, 10)
+    assert PrimaryKeyPagination.guard is None
+
+    crud.pagination_cache = PaginationCache()
+    with pytest.raises(QueryPlanError):
+        crud.list({}, {}, 10)
+
+
+def test_query_plan_guard_log(dbm, caplog):
+    guard = QueryPlanGuard(action='log')
+    query = PrimaryKeyPagination.paginate_query(
+        PlanModel.select(), 10, sort=[('name', 'asc')])
+    guard.check(query)
+    assert 'filesort' in caplog.text
+
+    with pytest.raises(ValueError):
+        QueryPlanGuard(action='ignore')
@@ -1,10 +1,13 @@
 import peewee
 import pytest
+import sqlite3
+import threading
+import time
 import playhouse.db_url
 
 from freezegun import freeze_time
 from peewee_extras import (Model, DatabaseRouter, DatabaseManager, 
-    TimestampModelMixin)
+    TimestampModelMixin, UUID7Field)
 
 ####################################################################
 # Fixtures and bases
@@ -51,6 +54,34 @@ def test_mm_already_registered(dbm, PlayModel):
     with pytest.raises(RuntimeError):
         dbm.models.register(PlayModel)
 
+def test_mm_fingerprints(dbm, PlayModel, caplog):
+    db = dbm['default']
+    table = PlayModel._meta.table_name
+    assert table in dbm.models.get_fingerprints(db)
+
+    # warm start is a single query
+    statements = []
+    execute_sql = db.execute_sql
+    db.execute_sql = lambda sql, *a, **kw: (
+        statements.append(sql) or execute_sql(sql, *a, **kw))
+    dbm.models.create_tables()
+    assert len(statements) == 1
+
+    # changed model gets missing indexes
+    PlayModel._meta.indexes = [(('name',), False)]
+    try:
+        dbm.models.create_tables()
+    finally:
+        PlayModel._meta.indexes = []
+    assert 'may need a migration' in caplog.text
+    assert [i.columns for i in db.get_indexes(table)] == [['name']]
+
+    # dropped tables are recreated
+    dbm.models.destroy_tables()
+    assert table not in dbm.models.get_fingerprints(db)
+    dbm.models.create_tables()
+    assert db.table_exists(table)
+
 
 ####################################################################
 # Router test
@@ -84,6 +115,138 @@ def test_database_router(dbm):
 
 
 
+####################################################################
+# Connection scope test
+####################################################################
+
+def test_connection_context():
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///:memory:')
+    dbm.register('other', 'sqlite:///:memory:')
+
+    @dbm.models.register
+    class PlayModel(PlayModelBase):
+        pass
+
+    with dbm.connection_context() as scope:
+        # nothing is connected until a model is used
+        assert dbm['default'].is_closed()
+        PlayModel.create_table()
+        assert dbm['other'].is_closed()
+        assert scope.databases == [dbm['default']]
+        assert dbm.leaked_connections(max_age=-1) == [scope]
+
+        # nested scopes leave outer connections alone
+        with dbm.connection_context() as inner:
+            PlayModel.create(name='hello')
+            assert inner.databases == []
+        assert not dbm['default'].is_closed()
+
+    assert dbm['default'].is_closed()
+    assert dbm.leaked_connections(max_age=-1) == []
+
+
+def test_connection_context_threads():
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///:memory:')
+    dbm.models.register(type('PlayModel', (PlayModelBase,), {}))
+
+    results = []
+    def worker():
+        with dbm.connection_context() as scope:
+            dbm.get_database(dbm.models[0])
+            results.append(len(scope.databases))
+
+    with dbm.connection_context():
+        dbm.checkout('default')
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join()
+
+    # connections are per thread, so the worker opened its own
+    assert results == [1]
+
+
+def test_lazy_connect():
+    dbm = DatabaseManager()
+    dbm.lazy_connect = True
+    dbm.idle_timeout = 30
+    dbm.register('default', 'sqlite:///:memory:')
+    dbm.register('other', 'sqlite:///:memory:')
+
+    @dbm.models.register
+    class PlayModel(PlayModelBase):
+        pass
+
+    dbm.connect()
+    assert dbm['default'].is_closed()
+    assert dbm['other'].is_closed()
+
+    # first use connects only the routed database
+    PlayModel.create_table()
+    assert not dbm['default'].is_closed()
+    assert dbm['other'].is_closed()
+
+    # idle connections are closed, but not mid transaction
+    dbm.checkout('other')
+    with dbm['default'].atomic():
+        dbm.disconnect_idle(time.time() + 60)
+        assert not dbm['default'].is_closed()
+    assert dbm['other'].is_closed()
+    dbm.disconnect_idle(time.time() + 60)
+    assert dbm['default'].is_closed()
+
+
+def test_idle_connections():
+    dbm = DatabaseManager()
+    dbm.lazy_connect = True
+    dbm.idle_timeout = 30
+    dbm.register('default', peewee.SqliteDatabase(':memory:'))
+
+    # the database about to be used is not closed and reopened
+    conn = dbm.checkout('default').connection()
+    for entry in dbm._idle.values():
+        entry[1] -= 60
+    assert dbm.checkout('default').connection() is conn
+    dbm.disconnect()
+
+    # idle connections of other threads are closed by the reaper
+    dbm = DatabaseManager()
+    dbm.lazy_connect = True
+    dbm.idle_timeout = 0.1
+    dbm.register('default', peewee.SqliteDatabase(':memory:',
+        check_same_thread=False))
+    db = dbm['default']
+    ready, reaped = threading.Event(), threading.Event()
+    results = []
+
+    def worker():
+        results.append(dbm.checkout('default').connection())
+        ready.set()
+        reaped.wait(5)
+        # reopened on next checkout
+        results.append(dbm.checkout('default').connection())
+        results.append(db.execute_sql('SELECT 1').fetchone())
+        db.close()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    ready.wait(5)
+    key = (thread.ident, db)
+    for x in range(100):
+        if dbm._idle.get(key, ()) is None:
+            break
+        time.sleep(0.05)
+    assert dbm._idle[key] is None
+    with pytest.raises(sqlite3.ProgrammingError):
+        results[0].execute('SELECT 1')
+    reaped.set()
+    thread.join()
+    assert results[1] is not results[0]
+    assert results[2] == (1,)
+    dbm.disconnect()
+
+
 ####################################################################
 # Model tests
 ####################################################################
@@ -159,3 +322,472 @@ def test_timestamp_model(dbm):
         o1 = PlayModel.create(name='hello')
         assert o1.created == dt
 
+
+
+####################################################################
+# Sharding test
+####################################################################
+
+from peewee_extras import (ShardRouter, HashShardingStrategy,
+    RangeShardingStrategy, LookupShardingStrategy, PrimaryKeyPagination)
+
+
+@pytest.fixture
+def sharded(dbm):
+    dbm.register('shard1', 'sqlite:///:memory:')
+    dbm.register('shard2', 'sqlite:///:memory:')
+    dbm['shard1'].connect()
+    dbm['shard2'].connect()
+
+    @dbm.models.register
+    class ShardModel(Model):
+        tenant = peewee.IntegerField()
+        name = peewee.TextField()
+
+    strategy = RangeShardingStrategy([(100, 'shard1'), (None, 'shard2')])
+    router = ShardRouter(dbm, [ShardModel], 'tenant', strategy)
+    dbm.routers.add(router)
+    router.create_tables()
+    return router, ShardModel
+
+
+def test_sharding_strategies():
+    s = HashShardingStrategy(['a', 'b', 'c'])
+    assert s.get_shard(42) == s.get_shard(42)
+    assert set(s.get_shard(x) for x in range(100)) == set(['a', 'b', 'c'])
+
+    s = RangeShardingStrategy([(10, 'a'), (20, 'b')])
+    assert s.get_shard(9) == 'a'
+    assert s.get_shard(10) == 'b'
+    with pytest.raises(ValueError):
+        s.get_shard(20)
+    with pytest.raises(ValueError):
+        RangeShardingStrategy([(20, 'a'), (10, 'b')])
+
+    s = LookupShardingStrategy({1: 'a', 2: 'b'}, default='c')
+    assert s.shards == ['a', 'b', 'c']
+    assert s.get_shard(2) == 'b'
+    assert s.get_shard(3) == 'c'
+
+
+def test_shard_router_instance(dbm, sharded):
+    router, ShardModel = sharded
+    router.save(ShardModel(tenant=1, name='a'))
+    router.save(ShardModel(tenant=500, name='b'))
+
+    with router.using(1):
+        assert ShardModel._meta.database == dbm['shard1']
+        assert [o.name for o in ShardModel.select()] == ['a']
+    with router.using(500):
+        assert [o.name for o in ShardModel.select()] == ['b']
+    assert router.current_shard is None
+
+
+def test_shard_router_query(dbm, sharded):
+    router, ShardModel = sharded
+    for tenant, name in [(1, 'd'), (2, 'b'), (500, 'c'), (501, 'a')]:
+        router.save(ShardModel(tenant=tenant, name=name))
+
+    query = ShardModel.select().where(ShardModel.tenant == 500)
+    assert router.get_shards_for_query(query) == ['shard2']
+    assert [o.name for o in router.execute(query)] == ['c']
+
+    query = ShardModel.select().where(ShardModel.tenant.in_([1, 501]))
+    assert router.get_shards_for_query(query) == ['shard1', 'shard2']
+
+    # column comparisons and subqueries can not be resolved to a shard
+    query = ShardModel.select().where(ShardModel.tenant == ShardModel.id)
+    assert router.get_shards_for_query(query) == ['shard1', 'shard2']
+    subquery = ShardModel.select(ShardModel.tenant)
+    query = ShardModel.select().where(ShardModel.tenant.in_(subquery))
+    assert router.get_shards_for_query(query) == ['shard1', 'shard2']
+
+    # keys missing from a lookup table are on no shard
+    lookup = ShardRouter(dbm, [ShardModel], 'tenant',
+        LookupShardingStrategy({1: 'shard1', 2: 'shard2'}))
+    query = ShardModel.select().where(ShardModel.tenant.in_([1, 3]))
+    assert lookup.get_shards_for_query(query) == ['shard1']
+    query = ShardModel.select().where(ShardModel.tenant == 3)
+    assert lookup.get_shards_for_query(query) == []
+
+    # scatter-gather merges ordered results and applies limits
+    query = ShardModel.select().order_by(ShardModel.name).limit(3)
+    assert router.get_shards_for_query(query) == ['shard1', 'shard2']
+    assert [o.name for o in router.execute(query)] == ['a', 'b', 'c']
+
+    query = PrimaryKeyPagination.paginate_query(
+        ShardModel.select(), count=2, sort=[('name', 'desc')])
+    assert [o.name for o in router.execute(query)] == ['d', 'c']
+
+
+def test_shard_router_nulls(dbm):
+    dbm.register('shard1', 'sqlite:///:memory:')
+    dbm.register('shard2', 'sqlite:///:memory:')
+
+    @dbm.models.register
+    class NullableModel(Model):
+        tenant = peewee.IntegerField()
+        name = peewee.TextField(null=True)
+
+    router = ShardRouter(dbm, [NullableModel], 'tenant',
+        RangeShardingStrategy([(100, 'shard1'), (None, 'shard2')]))
+    dbm.routers.add(router)
+    router.create_tables()
+    for tenant, name in [(1, 'b'), (2, None), (500, None), (501, 'a')]:
+        router.save(NullableModel(tenant=tenant, name=name))
+
+    # NULLs first ascending and last descending, as sqlite orders them
+    for direction, expected in [('asc', [None, None, 'a', 'b']),
+            ('desc', ['b', 'a', None, None])]:
+        query = PrimaryKeyPagination.paginate_query(
+            NullableModel.select(), count=10, sort=[('name', direction)])
+        assert [o.name for o in router.execute(query)] == expected
+
+
+def test_shard_router_foreign_key(dbm):
+    dbm.register('shard1', 'sqlite:///:memory:')
+    dbm.register('shard2', 'sqlite:///:memory:')
+
+    @dbm.models.register
+    class Tenant(Model):
+        name = peewee.TextField()
+
+    @dbm.models.register
+    class Item(Model):
+        tenant = peewee.ForeignKeyField(Tenant)
+        name = peewee.TextField()
+
+    dbm.models.create_tables()
+    router = ShardRouter(dbm, [Item], 'tenant',
+        RangeShardingStrategy([(3, 'shard1'), (None, 'shard2')]))
+    dbm.routers.add(router)
+    router.create_tables()
+
+    tenants = [Tenant.create(name=str(x)) for x in range(3)]
+    for tenant in tenants:
+        router.save(Item(tenant=tenant.id, name=tenant.name))
+    router.save(Item(tenant=tenants[2], name='instance'))
+
+    query = Item.select().where(Item.tenant == tenants[2].id)
+    assert router.get_shards_for_query(query) == ['shard2']
+    assert [o.name for o in router.execute(query)] == ['2', 'instance']
+    with router.using_shard('shard1'):
+        assert [o.name for o in Item.select().order_by(Item.id)] == ['0', '1']
+
+
+####################################################################
+# Change feed tests
+####################################################################
+
+def test_change_feed(dbm):
+    @dbm.models.register
+    class PlayModel(TimestampModelMixin, PlayModelBase):
+        pass
+
+    dbm.models.create_tables()
+    feed = PlayModel.change_feed(batch_size=3)
+    feed.create_index()
+    assert any(i.columns == ['modified', 'id']
+        for i in dbm['default'].get_indexes(PlayModel._meta.table_name))
+
+    # several rows share a timestamp
+    for x in range(7):
+        with freeze_time(datetime.datetime(2018, 1, 1, 0, 0, x // 3)):
+            PlayModel.create(name=str(x))
+
+    batches = list(feed.batches())
+    assert [[o.name for o in rows] for rows, token in batches] == [
+        ['0', '1', '2'], ['3', '4', '5'], ['6']]
+
+    # resume from a token, picking up later changes
+    token = batches[0][1]
+    with freeze_time(datetime.datetime(2018, 1, 2)):
+        o = PlayModel.get(name='1')
+        o.save()
+    names = [o.name for rows, t in feed.batches(token) for o in rows]
+    assert names == ['3', '4', '5', '6', '1']
+
+    # caught up
+    last = list(feed.batches(token))[-1][1]
+    assert list(feed.batches(last)) == []
+
+    with pytest.raises(ValueError):
+        list(feed.batches('invalid'))
+
+
+def test_change_feed_uuid(dbm):
+    @dbm.models.register
+    class UUIDModel(TimestampModelMixin):
+        id = UUID7Field(primary_key=True)
+        name = peewee.CharField()
+
+    dbm.models.create_tables()
+    with freeze_time(datetime.datetime(2018, 1, 1)):
+        for x in range(5):
+            UUIDModel.create(name=str(x))
+
+    feed = UUIDModel.change_feed(batch_size=2)
+    batches = list(feed.batches())
+    assert [[o.name for o in rows] for rows, token in batches] == [
+        ['0', '1'], ['2', '3'], ['4']]
+    assert list(feed.batches(batches[-1][1])) == []
+
+
+####################################################################
+# Circuit breaker tests
+####################################################################
+
+from peewee_extras import CircuitBreaker, CircuitOpenError
+
+
+class FlakyDatabase(peewee.SqliteDatabase):
+    fail = False
+
+    def execute_sql(self, sql, *args, **kwargs):
+        if self.fail:
+            raise peewee.OperationalError(
+                sqlite3.OperationalError('unable to open database file'))
+        return super(FlakyDatabase, self).execute_sql(sql, *args, **kwargs)
+
+
+@pytest.fixture
+def breaker(dbm):
+    dbm['default'].close()
+    dbm.register('default', FlakyDatabase(':memory:'))
+    dbm['default'].connect()
+    breaker = CircuitBreaker(alternates={'default': ['other']}, min_calls=3)
+    events = breaker.events = []
+    breaker.listeners.append(events.append)
+    dbm.use_circuit_breaker(breaker)
+    return breaker
+
+
+def test_circuit_breaker(dbm, breaker):
+    @dbm.models.register
+    class PlayModel(PlayModelBase):
+        pass
+
+    db = dbm['default']
+    dbm.models.create_tables()
+    dbm['other'].execute(PlayModel._schema._create_table())
+    PlayModel.create(name='default')
+
+    # failures open the circuit, routing falls back to alternate
+    db.fail = True
+    while breaker.health(db).state != 'open':
+        with pytest.raises(peewee.OperationalError):
+            PlayModel.get()
+    assert [(e.name, e.new_state) for e in breaker.events] == [
+        ('default', 'open')]
+    assert breaker.metrics()['default']['state'] == 'open'
+    assert PlayModel._meta.database is dbm['other']
+    assert PlayModel.select().count() == 0
+
+    # probes close it once the database recovers
+    assert breaker.probe_open() == []
+    db.fail = False
+    assert breaker.probe_open() == ['default']
+    assert PlayModel._meta.database is db
+    assert PlayModel.get().name == 'default'
+
+    # half open after reset timeout, next call decides
+    db.fail = True
+    while breaker.health(db).state != 'open':
+        with pytest.raises(peewee.OperationalError):
+            PlayModel.get()
+    db.fail = False
+    breaker.health(db).opened_at -= breaker.reset_timeout
+    assert PlayModel._meta.database is db
+    assert breaker.health(db).state == 'half_open'
+    PlayModel.get()
+    assert [e.new_state for e in breaker.events] == [
+        'open', 'closed', 'open', 'half_open', 'closed']
+
+
+def test_circuit_breaker_unavailable(dbm, breaker):
+    @dbm.models.register
+    class PlayModel(PlayModelBase):
+        pass
+
+    breaker.max_latency = 1
+    for x in range(3):
+        breaker.record(dbm['default'], 5)
+    assert breaker.health(dbm['default']).state == 'open'
+    breaker.alternates = {}
+    with pytest.raises(CircuitOpenError):
+        PlayModel.select().count()
+
+
+def test_circuit_breaker_failures(dbm, breaker):
+    db = dbm['default']
+    # statement errors are not failures
+    health = breaker.health(db)
+    calls = health.calls
+    for x in range(5):
+        with pytest.raises(peewee.OperationalError):
+            db.execute_sql('SELECT * FROM missing')
+    assert health.calls == calls and health.errors == 0
+    assert health.state == 'closed'
+
+    locked = peewee.OperationalError(
+        sqlite3.OperationalError('database is locked'))
+    assert breaker.is_failure(locked)
+    assert breaker.is_failure(peewee.InterfaceError('closed'))
+    # errors of peewee itself are not failures either
+    breaker.min_calls = 1
+    with pytest.raises(peewee.OperationalError):
+        db.connect()
+    assert not breaker.is_failure(
+        peewee.OperationalError('Connection already opened.'))
+    assert health.errors == 0 and health.state == 'closed'
+    assert not breaker.is_failure(peewee.IntegrityError('unique'))
+
+    # installing another breaker does not wrap the database twice
+    other = CircuitBreaker(min_calls=3)
+    dbm.use_circuit_breaker(other)
+    dbm.use_circuit_breaker(other)
+    db.execute_sql('SELECT 1')
+    assert other.health(db).calls == 1
+    assert health.calls == calls
+
+
+####################################################################
+# Tenant router tests
+####################################################################
+
+from peewee_extras import TenantRouter
+
+
+class WeakConnection(sqlite3.Connection):
+    """Connection supporting weak references, like psycopg2"""
+
+
+class RecordingTenantRouter(TenantRouter):
+    # sqlite has no search path, record the switches instead
+    def __init__(self, *args, **kwargs):
+        super(RecordingTenantRouter, self).__init__(*args, **kwargs)
+        self.switches = []
+
+    def get_switch_sql(self, db, tenant):
+        self.switches.append(tenant)
+        return 'SELECT 1'
+
+    def get_create_sql(self, db, tenant):
+        return 'SELECT 1'
+
+
+def test_tenant_router(dbm):
+    dbm['default'].close()
+    dbm.register('default', peewee.SqliteDatabase(':memory:',
+        factory=WeakConnection))
+    db = dbm['default']
+    db.connect()
+
+    @dbm.models.register
+    class PlayModel(PlayModelBase):
+        pass
+
+    @dbm.models.register
+    class SharedModel(PlayModelBase):
+        pass
+
+    router = RecordingTenantRouter(dbm, [PlayModel])
+    dbm.routers.add(router)
+
+    # tenants share the database, switching only when needed
+    with router.using('acme') as tenant_db:
+        assert tenant_db is db
+        assert PlayModel._meta.database is db
+        assert PlayModel._meta.database is db
+    with router.using('globex'):
+        assert PlayModel._meta.database is db
+        with router.using('acme'):
+            assert PlayModel._meta.database is db
+    assert PlayModel._meta.database is db
+    assert router.switches == ['acme', 'globex', 'acme', None]
+
+    # switches inside transactions are remembered until it ends
+    with db.atomic():
+        with router.using('acme'):
+            PlayModel._meta.database
+            PlayModel._meta.database
+    with router.using('acme'):
+        PlayModel._meta.database
+    assert router.switches[4:] == ['acme', 'acme']
+
+    # shared models switch the connection back to the default schema
+    with router.using('acme'):
+        assert SharedModel._meta.database is db
+        assert SharedModel._meta.database is db
+    assert router.switches[6:] == [None]
+
+    # routing alone does not touch the connection
+    with router.using('globex'):
+        assert router.get_database(PlayModel) is db
+    assert router.switches[7:] == []
+
+    with pytest.raises(ValueError):
+        with router.using('acme; DROP TABLE x'):
+            pass
+
+    # table existence is looked up once per tenant
+    db.execute_sql("ATTACH ':memory:' AS acme")
+    lookups = []
+    get_tables = db.get_tables
+    db.get_tables = lambda schema=None: (
+        lookups.append(schema) or get_tables(schema=schema))
+    assert router.create_tables('acme') == [PlayModel]
+    assert router.create_tables('acme') == []
+    assert router.table_exists(PlayModel, 'acme')
+    assert lookups == ['acme']
+
+
+def test_tenant_router_sql():
+    router = TenantRouter(DatabaseManager(), [])
+    pg = peewee.PostgresqlDatabase('test')
+    assert router.get_switch_sql(pg, 'acme') == (
+        'SET search_path TO "acme", public')
+    assert router.get_switch_sql(pg, None) == 'SET search_path TO DEFAULT'
+    assert router.get_create_sql(pg, 'acme') == (
+        'CREATE SCHEMA IF NOT EXISTS "acme"')
+    with pytest.raises(NotImplementedError):
+        router.get_switch_sql(peewee.SqliteDatabase(':memory:'), 'acme')
+
+
+class RecordingMySQLDatabase(peewee.MySQLDatabase):
+    def execute_sql(self, sql, params=None, commit=None):
+        self.executed = (sql, params)
+        return sqlite3.connect(':memory:').execute("SELECT 'playmodel'")
+
+
+def test_tenant_router_mysql_tables():
+    router = TenantRouter(DatabaseManager(), [])
+    db = RecordingMySQLDatabase('app')
+    assert router.get_tables(db, 'acme') == {'playmodel'}
+    assert db.executed == ('SELECT table_name FROM information_schema.tables '
+        'WHERE table_schema = %s', ('acme',))
+
+
+def test_tenant_router_failover(dbm):
+    for name in ['default', 'other']:
+        dbm[name].close()
+    dbm.register('default', FlakyDatabase(':memory:', factory=WeakConnection))
+    dbm.register('other', peewee.SqliteDatabase(':memory:',
+        factory=WeakConnection))
+
+    @dbm.models.register
+    class PlayModel(PlayModelBase):
+        pass
+
+    router = RecordingTenantRouter(dbm, [PlayModel])
+    dbm.routers.add(router)
+    breaker = CircuitBreaker(alternates={'default': ['other']})
+    dbm.use_circuit_breaker(breaker)
+    breaker._set_state(breaker.health(dbm['default']), breaker.OPEN,
+        time.monotonic())
+
+    # switched on the alternate only, the failed database is not used
+    with router.using('acme'):
+        assert PlayModel._meta.database is dbm['other']
+    assert router.switches == ['acme']
+    assert dbm['default'].is_closed()
@@ -0,0 +1,100 @@
+import concurrent.futures
+import multiprocessing
+import os
+
+import peewee
+import pytest
+
+from peewee_extras import Model, DatabaseManager, PartitionedScan
+
+####################################################################
+# Fixtures and bases
+####################################################################
+
+class ScanModel(Model):
+    name = peewee.TextField()
+    slug = peewee.TextField(null=True)
+
+
+class ScanUUIDModel(Model):
+    id = peewee.UUIDField(primary_key=True)
+
+
+class SlugScan(PartitionedScan):
+    model = ScanModel
+    batch_size = 7
+    fail_at = None
+
+    def process(self, rows):
+        if self.fail_at in [o.id for o in rows]:
+            raise RuntimeError('failed')
+        ids = [o.id for o in rows]
+        (ScanModel.update(slug=ScanModel.name.concat('-slug'))
+            .where(ScanModel.id.in_(ids)).execute())
+
+
+@pytest.fixture
+def dbm(tmpdir):
+    # connections are per worker, so use a file backed database
+    dbm = DatabaseManager()
+    dbm.register('default', 'sqlite:///{}'.format(tmpdir.join('scan.db')))
+    dbm.models.register(ScanModel)
+    dbm.models.register(ScanUUIDModel)
+    dbm.connect()
+    dbm.models.create_tables()
+    ScanModel.insert_many([{'name': str(x)} for x in range(100)]).execute()
+    yield dbm
+    dbm.disconnect()
+
+
+def slugged():
+    return ScanModel.select().where(ScanModel.slug.is_null(False)).count()
+
+
+####################################################################
+# Partitioned scan tests
+####################################################################
+
+def test_ranges(dbm):
+    assert SlugScan().get_ranges() == [
+        (None, 26), (26, 51), (51, 76), (76, None)]
+    assert SlugScan(split='quantiles').get_ranges() == [
+        (None, 26), (26, 51), (51, 76), (76, None)]
+
+    ScanModel.delete().execute()
+    assert SlugScan().get_ranges() == [(None, None)]
+
+    uuids = sorted(peewee.uuid.uuid4() for x in range(8))
+    ScanUUIDModel.insert_many([{'id': u} for u in uuids]).execute()
+    scan = PartitionedScan(model=ScanUUIDModel, partitions=2)
+    assert scan.get_ranges() == [(None, uuids[4]), (uuids[4], None)]
+
+
+def test_run_threads(dbm):
+    assert SlugScan().run() == 100
+    assert slugged() == 100
+    assert ScanModel.get_by_id(42).slug == '41-slug'
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='requires fork')
+def test_run_processes(dbm):
+    ctx = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(2, mp_context=ctx) as pool:
+        assert SlugScan().run(executor=pool) == 100
+    assert slugged() == 100
+
+
+def test_resume(dbm, tmpdir):
+    checkpoint = str(tmpdir.join('slug'))
+    scan = SlugScan(checkpoint=checkpoint, fail_at=40)
+    with pytest.raises(RuntimeError):
+        scan.run()
+    # range containing id 40 stopped after two batches
+    assert slugged() == 100 - 25 + 14
+    assert os.path.exists(checkpoint + '.json')
+
+    scan.fail_at = None
+    assert scan.run() == 25 - 14
+    assert slugged() == 100
+    assert not [name for name in os.listdir(str(tmpdir))
+        if name.startswith('slug')]
@@ -0,0 +1,147 @@
+import peewee
+import pytest
+
+from peewee_extras import Model, DatabaseManager
+
+####################################################################
+# Fixtures and bases
+####################################################################
+
+class Author(Model):
+    name = peewee.TextField(unique=True)
+
+
+class Book(Model):
+    author = peewee.ForeignKeyField(Author, backref='books')
+    title = peewee.TextField()
+    pages = peewee.IntegerField(default=0)
+
+
+class Category(Model):
+    parent = peewee.ForeignKeyField('self', null=True, backref='children')
+    name = peewee.TextField(null=True)
+
+
+class CountingDatabase(peewee.SqliteDatabase):
+    def __init__(self, *args, **kwargs):
+        super(CountingDatabase, self).__init__(*args, **kwargs)
+        self.statements = []
+
+    def execute_sql(self, sql, params=None, commit=peewee.SENTINEL):
+        self.statements.append(sql)
+        return super(CountingDatabase, self).execute_sql(sql, params)
+
+
+@pytest.fixture
+def dbm():
+    dbm = DatabaseManager()
+    dbm.register('default', CountingDatabase(':memory:'))
+    dbm.models.register(Author)
+    dbm.models.register(Book)
+    dbm.models.register(Category)
+    dbm.connect()
+    dbm.models.create_tables()
+    dbm['default'].statements[:] = []
+    yield dbm
+    dbm.disconnect()
+    for model in [Author, Book, Category]:
+        model._meta.database = None
+
+
+####################################################################
+# Unit of work tests
+####################################################################
+
+def test_batched_inserts(dbm):
+    db = dbm['default']
+    with dbm.unit_of_work() as uow:
+        authors = [Author.create(name=str(x)) for x in range(3)]
+        books = [Book.create(author=authors[x % 3], title=str(x))
+            for x in range(10)]
+        assert len(uow) == 13
+        assert db.statements == []
+
+    # one insert per model, parents first
+    inserts = [sql for sql in db.statements if sql.startswith('INSERT')]
+    assert len(inserts) == 2
+    assert '"author"' in inserts[0]
+    assert [a.id for a in authors] == [1, 2, 3]
+    assert [b.author_id for b in books] == [1, 2, 3, 1, 2, 3, 1, 2, 3, 1]
+    assert Book.select().where(Book.author == authors[1]).count() == 3
+    assert not books[0].is_dirty()
+
+
+def test_batched_updates_deletes(dbm):
+    author = Author.create(name='a')
+    books = [Book.create(author=author, title=str(x)) for x in range(5)]
+    db = dbm['default']
+    db.statements[:] = []
+
+    with dbm.unit_of_work():
+        for book in books:
+            book.update_instance(pages=int(book.title) * 10)
+        books[0].title = 'first'
+        books[0].save()
+        books[4].delete_instance()
+        # inserted and deleted within unit of work, never written
+        Book.create(author=author, title='tmp').delete_instance()
+
+    # without only_save_dirty all rows write the same columns
+    sql = [s for s in db.statements if s.split()[0] in ('UPDATE', 'DELETE')]
+    assert [s.split()[0] for s in sql] == ['UPDATE', 'DELETE']
+    assert not any(s.startswith('INSERT') for s in db.statements)
+    rows = Book.select().order_by(Book.id).tuples()
+    assert [(title, pages) for id, author, title, pages in rows] == [
+        ('first', 0), ('1', 10), ('2', 20), ('3', 30)]
+
+
+def test_rollback_discards(dbm):
+    with pytest.raises(ZeroDivisionError):
+        with dbm.unit_of_work():
+            Author.create(name='a')
+            1 / 0
+    assert Author.select().count() == 0
+
+
+def test_create_or_get_flushes(dbm):
+    with dbm.unit_of_work() as uow:
+        with dbm.unit_of_work() as inner:
+            assert inner is uow
+            author = Author.create(name='a')
+        assert author.id is None
+        other, created = Author.create_or_get(name='a')
+        assert not created and other.id == 1
+        assert author.id == 1
+        assert len(uow) == 0
+
+
+def test_self_referencing_inserts(dbm):
+    with dbm.unit_of_work():
+        # children buffered before their parents
+        leaf = Category(name='leaf')
+        middle = Category(name='middle')
+        root = Category(name='root')
+        leaf.parent = middle
+        middle.parent = root
+        for category in [leaf, middle, root]:
+            category.save()
+
+        # reference cycle
+        a, b = Category(name='a'), Category(name='b')
+        a.parent, b.parent = b, a
+        a.save()
+        b.save()
+
+    parents = {c.name: c.parent and c.parent.name
+        for c in Category.select()}
+    assert parents == {'root': None, 'middle': 'root', 'leaf': 'middle',
+        'a': 'b', 'b': 'a'}
+
+
+def test_default_values_insert(dbm):
+    with dbm.unit_of_work():
+        categories = [Category() for x in range(3)]
+        for category in categories:
+            category.save()
+    assert [c.id for c in categories] == [1, 2, 3]
+    assert Category.select().count() == 3